@@ -0,0 +1,207 @@
+import os
+import queue
+import threading
+import time
+from pykka import messages
+from disk_queue import DiskQueue
+
+"""
+Bounded actor mailboxes.
+
+By default a pykka actor's inbox is an unbounded queue, so if an actor can't
+keep up (e.g. the Firebase actor while Firestore is unreachable) its inbox grows
+without limit. Actors that inherit from `BoundedMailboxMixin` get a
+`BoundedInbox` instead, which limits the number of queued messages of the types
+listed in `mailbox_messages`. Other messages (including `ask`s and pykka's own
+stop messages) are never limited.
+
+What happens when the limit is reached depends on the overflow policy:
+    - "block": the sender waits until there is room (backpressure)
+    - "drop_oldest": the oldest limited message is discarded
+    - "spill": further messages are written to disk (see disk_queue.py) and
+      read back in order as the actor catches up; spilled messages also
+      survive a restart of the actor (messages already read back into memory
+      are discarded on stop, like any unprocessed pykka message)
+
+The limit and policy can be overridden per actor class with environment
+variables, e.g. `FIREBASE_MAILBOX_SIZE=500` and `FIREBASE_MAILBOX_POLICY=block`.
+"""
+
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+SPILL = "spill"
+POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+SPILL_DIR = os.getenv("MAILBOX_SPILL_DIR", "data/spill")
+
+class BoundedInbox(queue.Queue):
+    """
+    Actor inbox that limits the number of queued messages of the given types.
+    Keeps counters of how often the limit was hit, see `stats`.
+    """
+
+    def __init__(self, name, limited_types, maxsize, policy, logger=None, spill_path=None):
+        super().__init__()
+        if policy not in POLICIES:
+            raise ValueError(f"unknown mailbox overflow policy {policy!r}, expected one of {POLICIES}")
+        self.name = name
+        self.limited_types = tuple(limited_types)
+        self.limit = maxsize
+        self.policy = policy
+        self.logger = logger
+        self.limited_count = 0
+        self.space = threading.Condition(self.mutex)
+
+        # set once the actor has been told to stop; pykka then drains the
+        # inbox, which must not pull the spilled messages off the disk
+        self.stopping = False
+
+        # backpressure statistics
+        self.under_pressure = False
+        self.pressure_events = 0
+        self.blocked = 0
+        self.blocked_seconds = 0.0
+        self.dropped = 0
+        self.spilled = 0
+
+        self.spill = None
+        if policy == SPILL:
+            self.spill = DiskQueue(spill_path or os.path.join(SPILL_DIR, f"{name}.queue"))
+            with self.mutex:
+                self._refill()
+                if len(self.spill):
+                    self._log(f"{name} mailbox has {len(self.spill)} spilled messages from a previous run")
+
+    def _log(self, text):
+        if self.logger:
+            self.logger.warning(text)
+
+    def _is_limited(self, envelope):
+        return envelope.reply_to is None and isinstance(envelope.message, self.limited_types)
+
+    def _set_pressure(self, under_pressure):
+        # called with the mutex held; log only on transitions
+        if under_pressure and not self.under_pressure:
+            self.pressure_events += 1
+            self._log(f"{self.name} mailbox is full ({self.limit} messages), applying {self.policy} policy")
+        elif not under_pressure and self.under_pressure:
+            self._log(f"{self.name} mailbox has room again")
+        self.under_pressure = under_pressure
+
+    def _enqueue(self, envelope):
+        # called with the mutex held
+        self._put(envelope)
+        self.unfinished_tasks += 1
+        self.not_empty.notify()
+
+    def _refill(self):
+        """Move spilled messages back into memory while there is room."""
+        n = self.limit - self.limited_count
+        if n <= 0 or not len(self.spill) or self.stopping:
+            return
+        for envelope in self.spill.peek(n):
+            self._enqueue(envelope)
+            self.limited_count += 1
+        self.spill.drop(n)
+
+    def put(self, envelope, block=True, timeout=None):
+        if not self._is_limited(envelope):
+            return super().put(envelope, block, timeout)
+
+        with self.mutex:
+            if self.policy == BLOCK and self.limited_count >= self.limit:
+                self._set_pressure(True)
+                self.blocked += 1
+                start = time.monotonic()
+                while self.limited_count >= self.limit:
+                    self.space.wait()
+                self.blocked_seconds += time.monotonic() - start
+            elif self.policy == DROP_OLDEST and self.limited_count >= self.limit:
+                self._set_pressure(True)
+                for i, queued in enumerate(self.queue):
+                    if self._is_limited(queued):
+                        del self.queue[i]
+                        self.limited_count -= 1
+                        self.unfinished_tasks -= 1
+                        self.dropped += 1
+                        break
+            elif self.policy == SPILL and (self.limited_count >= self.limit or len(self.spill)):
+                # once spilling, keep spilling until the backlog is read back,
+                # so that messages stay in order
+                self._set_pressure(True)
+                self.spill.put(envelope)
+                self.spilled += 1
+                return
+
+            self._enqueue(envelope)
+            self.limited_count += 1
+
+    def get(self, block=True, timeout=None):
+        envelope = super().get(block, timeout)
+        # pykka's own stop message; pykka checks for it the same way
+        if isinstance(envelope.message, messages._ActorStop):
+            with self.mutex:
+                self.stopping = True
+        elif self._is_limited(envelope):
+            with self.mutex:
+                self.limited_count -= 1
+                if self.spill is not None:
+                    self._refill()
+                # only report relief once the mailbox has drained to half, so
+                # a mailbox hovering at its limit doesn't flood the log
+                if self.limited_count <= self.limit // 2 and not (self.spill is not None and len(self.spill)):
+                    self._set_pressure(False)
+                self.space.notify()
+        return envelope
+
+    def pending(self):
+        """Number of limited messages waiting, including spilled ones."""
+        with self.mutex:
+            return self.limited_count + (len(self.spill) if self.spill is not None else 0)
+
+    def stats(self):
+        """Current state and counters of the mailbox."""
+        with self.mutex:
+            return {
+                "queued": self.limited_count,
+                "limit": self.limit,
+                "policy": self.policy,
+                "under_pressure": self.under_pressure,
+                "pressure_events": self.pressure_events,
+                "blocked": self.blocked,
+                "blocked_seconds": round(self.blocked_seconds, 3),
+                "dropped": self.dropped,
+                "spilled": self.spilled,
+                "spill_backlog": len(self.spill) if self.spill is not None else 0,
+            }
+
+class BoundedMailboxMixin:
+    """
+    Mixin for pykka.ThreadingActor subclasses to give them a BoundedInbox.
+    Set these class attributes:
+        - `mailbox_messages`: tuple of message types that are limited
+        - `mailbox_size`: maximum number of queued limited messages
+        - `mailbox_policy`: overflow policy, one of POLICIES
+        - `mailbox_logger`: logger for backpressure warnings (optional)
+    """
+    mailbox_messages = ()
+    mailbox_size = 100
+    mailbox_policy = BLOCK
+    mailbox_logger = None
+
+    def _create_actor_inbox(self):
+        # called by pykka from Actor.__init__
+        name = type(self).__name__
+        env_prefix = f"{name.upper()}_MAILBOX"
+        return BoundedInbox(
+            name=name,
+            limited_types=self.mailbox_messages,
+            maxsize=int(os.getenv(f"{env_prefix}_SIZE", self.mailbox_size)),
+            policy=os.getenv(f"{env_prefix}_POLICY", self.mailbox_policy),
+            logger=self.mailbox_logger,
+        )
+
+def mailbox_stats(actor_ref):
+    """Mailbox stats for an actor, or None if its inbox isn't bounded."""
+    inbox = actor_ref.actor_inbox
+    return inbox.stats() if isinstance(inbox, BoundedInbox) else None
@@ -0,0 +1,174 @@
+import math
+from dataclasses import dataclass
+
+"""
+Streaming detection of sensor faults.
+
+Fixed min/max tolerances (see notifs.py) catch water quality problems, but not a
+probe that is stuck, disconnected or drifting while still reading a plausible
+value. `AnomalyDetector` looks at each new sample as it arrives and keeps a few
+numbers of state per field (exponentially weighted means and variance, the last
+value and a counter), so the cost per sample is constant however long it runs.
+
+The detector reports these kinds of faults:
+    - "invalid": the value is missing or NaN
+    - "flatline": the value hasn't changed at all for several samples
+    - "spike": the value is far outside the recent distribution; reported
+      with the next normal sample, once it is clear the spike wasn't the start
+      of a level shift
+    - "level_shift": several spikes in a row; the detector adopts the new level
+    - "drift": the short term mean has wandered away from the long term mean;
+      it only counts as over once the two have come back to within half the
+      threshold, so a drift hovering around the threshold is reported once
+
+An event is emitted when a fault starts, not on every sample while it lasts.
+"""
+
+@dataclass
+class FaultEvent:
+    """A detected sensor fault."""
+    field: str
+    kind: str
+    value: float
+    message: str
+
+class FieldDetector:
+    """Fault detection state for a single field."""
+
+    def __init__(
+        self,
+        alpha=0.05,
+        slow_alpha=0.002,
+        spike_z=8.0,
+        drift_z=3.0,
+        flatline_count=8,
+        flatline_tolerance=1e-9,
+        level_shift_count=3,
+        warmup=20,
+    ):
+        self.alpha = alpha
+        self.slow_alpha = slow_alpha
+        self.spike_z = spike_z
+        self.drift_z = drift_z
+        self.flatline_count = flatline_count
+        self.flatline_tolerance = flatline_tolerance
+        self.level_shift_count = level_shift_count
+        self.warmup = warmup
+        self.reset()
+
+    def reset(self):
+        """Forget everything learned about the field."""
+        self.n = 0
+        self.mean = 0.0
+        self.slow_mean = 0.0
+        self.var = 0.0
+        self.last = None
+        self.unchanged = 0
+        self.outliers = 0
+        self.pending_spike = None
+        self.active = set()
+
+    def _restart_at(self, value):
+        self.n = 1
+        self.mean = self.slow_mean = value
+        self.var = 0.0
+        self.outliers = 0
+        self.pending_spike = None
+
+    def update(self, value):
+        """Feed one value. Returns a list of (kind, value, message) for faults
+        that started with this value (or, for spikes, with the value before
+        it)."""
+        found = {}
+
+        if value is None or value != value:
+            found["invalid"] = "no valid reading"
+            return self._transition(found, value, keep=("drift",))
+
+        # flatline: identical readings from a probe that normally has noise
+        if self.last is not None and abs(value - self.last) <= self.flatline_tolerance:
+            self.unchanged += 1
+        else:
+            self.unchanged = 0
+        self.last = value
+        if self.unchanged + 1 >= self.flatline_count:
+            found["flatline"] = f"reading stuck at {value} for {self.unchanged + 1} samples"
+        elif "flatline" in self.active:
+            # the probe came back; what was learned while it was stuck is
+            # meaningless
+            self.n = 0
+
+        if self.n == 0:
+            self._restart_at(value)
+            return self._transition(found, value)
+
+        std = math.sqrt(self.var)
+        z = abs(value - self.mean) / std if std > 0 else 0.0
+        if self.n >= self.warmup and z > self.spike_z:
+            # don't let outliers pollute the statistics, unless they persist,
+            # in which case the process has moved to a new level
+            self.outliers += 1
+            if self.outliers >= self.level_shift_count:
+                found["level_shift"] = (value, f"reading jumped from about {self.mean:.4g} to {value:.4g}")
+                self._restart_at(value)
+            elif self.pending_spike is None:
+                # hold the spike back until it's clear it isn't the start of
+                # a level shift
+                self.pending_spike = (value, f"reading {value:.4g} is {z:.1f} standard deviations "
+                                             f"from recent mean {self.mean:.4g}")
+            # the drift check is skipped for outliers, so a drift stays active
+            return self._transition(found, value, keep=("drift",) if "level_shift" not in found else ())
+        self.outliers = 0
+        if self.pending_spike is not None:
+            found["spike"] = self.pending_spike
+            self.pending_spike = None
+
+        # exponentially weighted mean and variance
+        diff = value - self.mean
+        incr = self.alpha * diff
+        self.mean += incr
+        self.var = (1 - self.alpha) * (self.var + diff * incr)
+        self.slow_mean += self.slow_alpha * (value - self.slow_mean)
+        self.n += 1
+
+        std = math.sqrt(self.var)
+        # once drifting, only recover well below the threshold (hysteresis)
+        drift_z = self.drift_z / 2 if "drift" in self.active else self.drift_z
+        if self.n >= self.warmup and std > 0 and abs(self.mean - self.slow_mean) > drift_z * std:
+            found["drift"] = f"recent mean {self.mean:.4g} has drifted from long term mean {self.slow_mean:.4g}"
+
+        return self._transition(found, value)
+
+    def _transition(self, found, value, keep=()):
+        """Report faults that were not already active. Values of `found` are
+        messages, or (value, message) for faults about an earlier value.
+        Active faults of the kinds in `keep` stay active even if not found
+        again, because they weren't checked for this value."""
+        started = []
+        for kind, message in found.items():
+            if kind not in self.active:
+                event_value, message = message if isinstance(message, tuple) else (value, message)
+                started.append((kind, event_value, message))
+        # spikes and level shifts are one-off events rather than states
+        self.active = ({kind for kind in found if kind not in ("spike", "level_shift")}
+                       | (self.active & set(keep)))
+        return started
+
+class AnomalyDetector:
+    """Fault detection over all fields of a stream of samples."""
+
+    def __init__(self, field_names, **detector_args):
+        self.detectors = {name: FieldDetector(**detector_args) for name in field_names}
+
+    def update(self, sample):
+        """Feed one sample, given as a dataclass or dict. Fields missing from
+        the sample are skipped. Returns a list of FaultEvents."""
+        if not isinstance(sample, dict):
+            sample = sample.__dict__
+        events = []
+        for name, detector in self.detectors.items():
+            if name not in sample:
+                continue
+            for kind, value, message in detector.update(sample[name]):
+                events.append(FaultEvent(field=name, kind=kind, value=value, message=f"{name}: {message}"))
+        return events
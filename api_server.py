@@ -1,13 +1,15 @@
 import aiohttp
 from aiohttp import web
 import asyncio
+import math
 import pykka
 import threading
-import cv2
-import numpy as np
-import time
 from logs import register_logger
-from sensors import CollectAndSendData, Sensors
+from sensors import CollectAndSendData, get_actor_sensors, get_flow_meter
+from history import HISTORY_DIR, HistoryStore, export_bytes, parse_time
+from stream import RECORDINGS_DIR, FrameSource, Recorder
+from actor_mailbox import mailbox_stats
+from tanks import default_tank, find_tank
 server_logger = register_logger("logs/api_server.log", "API Server")
 
 routes = web.RouteTableDef()
@@ -19,6 +21,22 @@ async def request_logger(request, handler):
     server_logger.debug(f"Sent response: {response}")
     return response
 
+def get_tank(request):
+    """The tank selected by the `tank` query parameter, or the first tank if
+    it is absent."""
+    try:
+        return find_tank(request.app['tanks'], request.query.get('tank'))
+    except KeyError as e:
+        raise web.HTTPNotFound(text=str(e))
+
+def get_camera(request):
+    """The (frame source, recorder) pair of the selected tank's camera."""
+    tank = get_tank(request)
+    camera = request.app['cameras'].get(tank.camera_index)
+    if camera is None:
+        raise web.HTTPNotFound(text=f"tank {tank.tank_id!r} has no camera")
+    return camera
+
 @routes.get('/')
 async def handle_root(request):
     # redirect to the autoaquaponics.org website
@@ -26,8 +44,7 @@ async def handle_root(request):
 
 @routes.get('/api/measure_now')
 async def handle_measure_now(request):
-    lst = pykka.ActorRegistry.get_by_class(Sensors)
-    actor_sensors = lst[0] if lst else None
+    actor_sensors = get_actor_sensors(get_tank(request).tank_id)
 
     if actor_sensors:
         actor_sensors.tell(CollectAndSendData())
@@ -35,45 +52,72 @@ async def handle_measure_now(request):
     else:
         return web.json_response({'message': 'No sensors actor found'}, status=500)
 
-def draw_pattern():
-    img = np.full((480, 640, 3), 255, dtype=np.uint8)
-
-    # Create an interesting pattern that changes over time
-    t = time.time()
+@routes.get('/api/flow')
+async def handle_flow(request):
+    tank_id = get_tank(request).tank_id
 
-    # Make a copy of base image
-    pattern_img = img.copy()
+    # read the flow meter directly rather than asking the sensors actor,
+    # which may be busy taking measurements for several seconds
+    flow_meter = get_flow_meter(tank_id)
+    if flow_meter:
+        return web.json_response({'tank_id': tank_id, **flow_meter.stats()})
+    else:
+        return web.json_response({'message': 'No flow meter found'}, status=500)
 
-    # Draw animated sine wave pattern
-    for x in range(0, 640, 5):
-        y = int(240 + 100 * np.sin(x/50 + t))
-        cv2.circle(pattern_img, (x, y), 3, (0, 127, 255), -1)
+@routes.get('/api/status/mailboxes')
+async def handle_mailbox_status(request):
+    # backpressure state of every actor with a bounded mailbox
+    status = {}
+    for actor_ref in pykka.ActorRegistry.get_all():
+        if (stats := mailbox_stats(actor_ref)) is not None:
+            status[actor_ref.actor_class.__name__] = stats
+    return web.json_response(status)
 
-    # Draw animated circular pattern
-    center_x = 320 + int(50 * np.cos(t))
-    center_y = 240 + int(50 * np.sin(t))
-    radius = int(100 + 20 * np.sin(2*t))
-    cv2.circle(pattern_img, (center_x, center_y), radius, (255, 0, 127), 2)
+@routes.get('/api/export')
+async def handle_export(request):
+    # query parameters: start, end (unix seconds or ISO date), fields (comma
+    # separated) and tank; all optional
+    history_dir = get_tank(request).data_dir(HISTORY_DIR)
+    try:
+        start = parse_time(request.query.get('start'))
+        end = parse_time(request.query.get('end'))
+        fields = request.query.get('fields')
+        field_names = fields.split(',') if fields else None
+    except ValueError as e:
+        return web.json_response({'message': f'Invalid query: {e}'}, status=400)
 
-    # Add some text
-    cv2.putText(pattern_img, 'AutoAquaponics', (20, 50),
-                cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+    def build_export():
+        columns = HistoryStore(history_dir).read(start, end, field_names)
+        return export_bytes(columns)
 
-    # Encode image to JPEG
-    success, jpeg_img = cv2.imencode('.jpg', pattern_img)
-    if not success:
-        raise Exception("Failed to encode JPEG")
-    return jpeg_img
+    # reading and compressing is CPU bound, so keep it off the event loop
+    try:
+        data = await asyncio.get_running_loop().run_in_executor(None, build_export)
+    except ValueError as e:
+        return web.json_response({'message': str(e)}, status=400)
 
-# TODO move to stream.py
-capture = None
+    response = web.StreamResponse(headers={
+        'Content-Type': 'application/octet-stream',
+        'Content-Disposition': 'attachment; filename="sensor_history.npz"',
+    })
+    response.content_length = len(data)
+    await response.prepare(request)
+    chunk_size = 1 << 16
+    for i in range(0, len(data), chunk_size):
+        await response.write(data[i:i + chunk_size])
+    await response.write_eof()
+    return response
 
 @routes.get('/stream')
 async def handle_websocket(request):
+    frame_source, _ = get_camera(request)
     ws = web.WebSocketResponse()
     await ws.prepare(request)
     server_logger.debug("Websocket connection opened")
+    last_seq = None
 
+    # capture at full rate only while someone is watching
+    frame_source.add_viewer()
     try:
         while True:
             try:
@@ -90,22 +134,12 @@ async def handle_websocket(request):
                     # no message from client, continue with sending
                     pass
 
-                # TODO this should be moved to stream.py
-                # get the next frame
-                global capture
-                if capture is not None and capture.isOpened():
-                    ret, frame = capture.read()
-                    if ret:
-                        success, jpeg_img = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
-                        if not success:
-                            jpeg_img = draw_pattern()
-                    else:
-                        jpeg_img = draw_pattern()
-                else:
-                    jpeg_img = draw_pattern()
-
-                # send the frame
-                await ws.send_bytes(jpeg_img.tobytes())
+                # send the latest frame, which has already been captured and
+                # encoded by the frame source
+                frame = frame_source.latest
+                if frame is not None and frame.seq != last_seq:
+                    await ws.send_bytes(frame.jpeg)
+                    last_seq = frame.seq
 
                 # wait for the next frame
                 await asyncio.sleep(0.033)
@@ -113,6 +147,7 @@ async def handle_websocket(request):
                 server_logger.error(f"Error streaming image: {str(e)}")
                 break
     finally:
+        frame_source.remove_viewer()
         if not ws.closed:
             await ws.close()
         server_logger.debug("Websocket connection closed")
@@ -120,27 +155,78 @@ async def handle_websocket(request):
     return ws
 
 
-def make_server_runner():
+@routes.get('/api/clip')
+async def handle_clip(request):
+    # either start and end, or time (e.g. of an alert) with optional before
+    # and after in seconds (default 60 each); times are unix seconds or ISO
+    try:
+        if 'time' in request.query:
+            t = parse_time(request.query['time'])
+            start = t - float(request.query.get('before', 60))
+            end = t + float(request.query.get('after', 60))
+        else:
+            start = parse_time(request.query['start'])
+            end = parse_time(request.query['end'])
+    except (KeyError, TypeError, ValueError) as e:
+        return web.json_response({'message': f'Invalid query: {e}'}, status=400)
+    # empty parameters parse as None, and before/after can be infinite
+    if start is None or end is None or not (math.isfinite(start) and math.isfinite(end)):
+        return web.json_response({'message': 'Invalid query: the clip needs a finite start and end'}, status=400)
+
+    _, recorder = get_camera(request)
+    frames = recorder.clip(start, end)
+    loop = asyncio.get_running_loop()
+    response = web.StreamResponse(headers={
+        'Content-Type': 'video/x-motion-jpeg',
+        'Content-Disposition': f'attachment; filename="clip_{int(start)}.mjpeg"',
+    })
+    await response.prepare(request)
+    # read frames from disk off the event loop, one at a time
+    while (item := await loop.run_in_executor(None, next, frames, None)) is not None:
+        _, jpeg = item
+        await response.write(jpeg)
+    await response.write_eof()
+    return response
+
+def make_server_runner(tanks, cameras):
     app = web.Application()
+    app['tanks'] = tanks
+    app['cameras'] = cameras
     app.add_routes(routes)
     app.middlewares.append(request_logger)
     runner = web.AppRunner(app)
     return runner
 
 class Server(pykka.ThreadingActor):
-    def __init__(self, port=8080, server_logger=server_logger):
+    def __init__(self, tanks=None, port=8080, server_logger=server_logger):
         super().__init__()
         self.logger = server_logger
+        self.tanks = tanks or [default_tank()]
         self.port = port
         self.event_loop = None
         self.thread = None
 
+        # (frame source, recorder) per camera index; tanks sharing a camera
+        # share its stream and recordings
+        self.cameras = {}
+
     def on_start(self):
         try:
             self.logger.info(f"Starting API server on port {self.port}")
 
+            # start capturing from each camera and recording what it sees
+            for tank in self.tanks:
+                if tank.camera_index is None or tank.camera_index in self.cameras:
+                    continue
+                recorder = Recorder(tank.data_dir(RECORDINGS_DIR))
+                frame_source = FrameSource(camera_index=tank.camera_index, idle_interval=recorder.record_interval)
+                self.cameras[tank.camera_index] = (frame_source, recorder)
+                recorder.start()
+                frame_source.add_sink(recorder.submit)
+                frame_source.start()
+
             # build the web server object
-            runner = make_server_runner()
+            runner = make_server_runner(self.tanks, self.cameras)
 
             def worker():
                 # run the application; copied from
@@ -153,11 +239,6 @@ class Server(pykka.ThreadingActor):
                 self.event_loop.run_forever()
             self.thread = threading.Thread(target=worker, daemon=True)
             self.thread.start()
-
-            # TODO move to stream.py
-            # initialize capture object
-            global capture
-            capture = cv2.VideoCapture(0)
         except Exception as e:
             self.logger.error(f"Error starting API server: {e}")
             raise e
@@ -169,10 +250,9 @@ class Server(pykka.ThreadingActor):
         if self.thread:
             self.thread.join(timeout=1)
 
-        # TODO move to stream.py
-        global capture
-        if capture:
-            capture.release()
+        for frame_source, recorder in self.cameras.values():
+            frame_source.stop()
+            recorder.stop()
 
     def on_failure(self, failure):
         self.logger.error(f"API server actor failed: {failure}")
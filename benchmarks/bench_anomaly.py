@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from anomaly import AnomalyDetector
+
+"""
+Benchmark for the streaming sensor fault detector (anomaly.py).
+
+Generates synthetic sensor streams with injected faults (a stuck probe, a
+spike, a step and a slow drift), feeds them through AnomalyDetector one sample
+at a time and reports throughput and which faults were found where.
+
+Each injected fault should produce exactly one event in its field within
+WINDOW samples of the injection. Further events in that field and window are
+reported as duplicates (each would be a separate alert), and events outside
+every fault's window as false alarms.
+
+    python benchmarks/bench_anomaly.py [number of samples]
+"""
+
+FIELDS = ["pH", "TDS", "dissolved_oxygen", "air_temp", "humidity", "flow"]
+WINDOW = 2000
+BASELINES = {"pH": (7.0, 0.05), "TDS": (350, 5), "dissolved_oxygen": (7.5, 0.1),
+             "air_temp": (22, 0.3), "humidity": (55, 1.0), "flow": (800, 15)}
+
+def make_stream(n, rng):
+    """Synthetic samples as a dict of arrays, plus the injected faults as
+    (field, kind, index)."""
+    data = {name: rng.normal(mean, std, n) for name, (mean, std) in BASELINES.items()}
+    data["unix_time"] = 1_700_000_000 + 900 * np.arange(n)
+    injected = []
+
+    # pH probe gets stuck
+    i = n // 5
+    data["pH"][i:i + 50] = data["pH"][i]
+    injected.append(("pH", "flatline", i))
+
+    # single TDS spike
+    i = 2 * n // 5
+    data["TDS"][i] += 200
+    injected.append(("TDS", "spike", i))
+
+    # flow drops to a new level
+    i = 3 * n // 5
+    data["flow"][i:] -= 400
+    injected.append(("flow", "level_shift", i))
+
+    # dissolved oxygen probe slowly drifts, by 2 mg/L over 10 days of
+    # 15 minute samples
+    i = 4 * n // 5
+    data["dissolved_oxygen"][i:] += np.minimum(np.arange(n - i) * (2 / 960), 2)
+    injected.append(("dissolved_oxygen", "drift", i))
+
+    return data, injected
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    rng = np.random.default_rng(0)
+    data, injected = make_stream(n, rng)
+
+    # convert to plain python samples up front so only the detector is timed
+    columns = {name: data[name].tolist() for name in ["unix_time"] + FIELDS}
+    samples = [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+    detector = AnomalyDetector(FIELDS)
+    events = []
+    start = time.perf_counter()
+    for i, sample in enumerate(samples):
+        for event in detector.update(sample):
+            events.append((i, event))
+    elapsed = time.perf_counter() - start
+
+    print(f"{n} samples x {len(FIELDS)} fields in {elapsed:.3f} s "
+          f"({n / elapsed:,.0f} samples/s, {elapsed / n / len(FIELDS) * 1e6:.2f} us per field)")
+    print(f"{len(events)} fault events")
+    attributed = set()
+    for field, kind, index in injected:
+        in_window = [(i, e) for i, e in events if e.field == field and index <= i < index + WINDOW]
+        attributed.update(id(e) for _, e in in_window)
+        found = [i for i, e in in_window if e.kind == kind]
+        delay = f"after {found[0] - index} samples" if found else "NOT DETECTED"
+        extra = [f"{e.kind}@{i}" for i, e in in_window if not found or i != found[0]]
+        duplicates = f", {len(extra)} duplicate(s): {', '.join(extra)}" if extra else ""
+        print(f"  injected {kind:<12} in {field:<17} at {index}: {delay}{duplicates}")
+    false_alarms = [f"{e.field} {e.kind}@{i}" for i, e in events if id(e) not in attributed]
+    print(f"  events outside any fault's window (false alarms): {len(false_alarms)}"
+          + (f": {', '.join(false_alarms[:10])}" if false_alarms else ""))
+
+if __name__ == "__main__":
+    main()
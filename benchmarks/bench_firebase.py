@@ -0,0 +1,166 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+"""
+Load test of the Firebase actor's write path and listener fan-out, using the
+in-process Firestore stand-in (fake_firestore.py) instead of real credentials.
+
+Measures:
+    - write throughput: how fast a burst of AddSensorData messages ends up in
+      the stats collection
+    - listener latency: time from AddSensorData to the StatsUpdate reaching a
+      subscribed actor
+    - alert latency: time from an out of range sample to Notifs sending the
+      Slack alert, end to end through Firebase and the stats listener
+    - outage recovery: time to upload the backlog after an outage
+
+    python benchmarks/bench_firebase.py [--samples N] [--latency SECONDS]
+
+`--latency` simulates the round trip time of every Firestore request.
+"""
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def sample(unix_time, pH=7.0):
+    from sensors_data import SensorData
+    return SensorData(unix_time=unix_time, pH=pH, flow=800.0, air_temp=22.0, humidity=55.0,
+                      TDS=350.0, dissolved_oxygen=7.5)
+
+def wait_for(condition, timeout=120):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("benchmark timed out")
+        time.sleep(0.001)
+
+def percentiles(values):
+    values = np.asarray(values) * 1000
+    return f"p50 {np.percentile(values, 50):.2f} ms, p99 {np.percentile(values, 99):.2f} ms, max {values.max():.2f} ms"
+
+def bench_write_throughput(n, latency):
+    from fake_firestore import FakeFirestoreBackend
+    from firebase import AddSensorData, Firebase
+    backend = FakeFirestoreBackend(latency=latency)
+    actor = Firebase.start(backend=backend)
+    stats = lambda: backend.client.collections.get("stats", {})
+    wait_for(lambda: backend.client.watches)
+
+    start = time.perf_counter()
+    for i in range(n):
+        actor.tell(AddSensorData(sample(i)))
+    wait_for(lambda: len(stats()) >= n)
+    elapsed = time.perf_counter() - start
+    print(f"write throughput: {n} samples in {elapsed:.2f} s ({n / elapsed:,.0f} samples/s, "
+          f"{backend.client.request_count} Firestore requests)")
+    actor.stop()
+
+def bench_listener_latency(n, latency):
+    import pykka
+    from fake_firestore import FakeFirestoreBackend
+    from firebase import AddSensorData, Firebase, StatsUpdate, SubscribeToStats
+
+    received = {}
+
+    class Probe(pykka.ThreadingActor):
+        def on_receive(self, message):
+            if isinstance(message, StatsUpdate):
+                received.setdefault(message.data["unix_time"], time.perf_counter())
+
+    backend = FakeFirestoreBackend(latency=latency)
+    actor = Firebase.start(backend=backend)
+    probe = Probe.start()
+    actor.ask(SubscribeToStats(actor_ref=probe))
+
+    sent = {}
+    for i in range(1, n + 1):
+        sent[i] = time.perf_counter()
+        actor.tell(AddSensorData(sample(i)))
+        wait_for(lambda: i in received)
+    latencies = [received[i] - sent[i] for i in sent]
+    print(f"listener latency over {n} samples: {percentiles(latencies)}")
+    probe.stop()
+    actor.stop()
+
+def bench_alert_latency(n, latency):
+    import notifs
+    from fake_firestore import FakeFirestoreBackend
+    from firebase import AddSensorData, Firebase
+    from notifs import Notifs
+
+    alerts = []
+    notifs.send_slack_message = lambda body: alerts.append(time.perf_counter())
+    notifs.send_email = lambda recipient, subject, body: None
+
+    backend = FakeFirestoreBackend(latency=latency)
+    db = backend.client
+    db.collection("tolerances").document("pH").set({"min": 6.0, "max": 8.0})
+    db.collection("users").add({"email": "test@example.com", "email_notifications": True})
+    actor = Firebase.start(backend=backend)
+    actor_notifs = Notifs.start()
+
+    # the first update after startup never alerts
+    actor.tell(AddSensorData(sample(0)))
+    wait_for(lambda: actor_notifs.proxy().seen_tanks.get())
+
+    latencies = []
+    for i in range(1, n + 1):
+        count = len(alerts)
+        start = time.perf_counter()
+        actor.tell(AddSensorData(sample(i, pH=9.0)))
+        wait_for(lambda: len(alerts) > count)
+        latencies.append(alerts[-1] - start)
+    print(f"alert latency over {n} alerts: {percentiles(latencies)}")
+    actor_notifs.stop()
+
+def bench_outage_recovery(n, latency):
+    from fake_firestore import FakeFirestoreBackend
+    from firebase import AddSensorData, Firebase, Reconnect
+    backend = FakeFirestoreBackend(latency=latency)
+    actor = Firebase.start(backend=backend)
+    wait_for(lambda: actor.proxy().online.get())
+    backend.client.set_online(False)
+
+    for i in range(n):
+        actor.tell(AddSensorData(sample(i)))
+    # the first failed upload takes the actor offline
+    wait_for(lambda: not actor.proxy().online.get())
+    wait_for(lambda: len(actor.proxy().outbox.get()) >= n)
+
+    backend.client.set_online(True)
+    start = time.perf_counter()
+    actor.tell(Reconnect())
+    wait_for(lambda: len(backend.client.collections.get("stats", {})) >= n)
+    elapsed = time.perf_counter() - start
+    print(f"outage recovery: uploaded {n} queued samples in {elapsed:.2f} s "
+          f"({backend.client.request_count} Firestore requests)")
+    actor.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Firebase actor against a fake Firestore.")
+    parser.add_argument("--samples", type=int, default=2000, help="samples for the throughput tests")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated Firestore round trip in seconds")
+    args = parser.parse_args()
+
+    # run in a scratch directory so logs, outbox and spill files don't mix
+    # with real data
+    workdir = tempfile.mkdtemp(prefix="bench_firebase_")
+    os.makedirs(os.path.join(workdir, "logs"))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    print(f"working directory: {workdir}")
+
+    import pykka
+    try:
+        bench_write_throughput(args.samples, args.latency)
+        bench_listener_latency(min(args.samples, 500), args.latency)
+        bench_alert_latency(min(args.samples, 100), args.latency)
+        bench_outage_recovery(args.samples, args.latency)
+    finally:
+        pykka.ActorRegistry.stop_all()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import argparse
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from stream import MotionGate
+
+"""
+Benchmark for the motion-gated frame rate of the camera stream (stream.py).
+
+Plays back footage on a simulated clock, once capturing and encoding every
+frame at the full frame rate as the stream used to, and once letting a
+MotionGate decide when to capture and which frames to encode (plus a keyframe
+every KEYFRAME_INTERVAL seconds, as FrameSource does). Reports frames captured
+and encoded, CPU time spent in gating plus encoding, and bytes that would be
+sent to each viewer.
+
+    python benchmarks/bench_motion.py --video footage.mp4
+    python benchmarks/bench_motion.py            # synthetic footage
+
+The footage must be ungated, e.g. a video taken straight from the camera.
+Recorder segments (data/recordings) are not suitable: they only hold frames
+that already passed the MotionGate, thinned to the recording rate, so they
+would understate how much the gate saves.
+"""
+
+FRAME_INTERVAL = 0.033
+KEYFRAME_INTERVAL = 2.0
+
+def load_video(path):
+    capture = cv2.VideoCapture(path)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30
+    frames = []
+    while True:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        frames.append(frame)
+    capture.release()
+    return np.arange(len(frames)) / fps, frames
+
+def synthetic_footage(seconds=120, fps=30, seed=0):
+    """A static, noisy tank scene with a fish swimming through it for 20% of
+    the time."""
+    rng = np.random.default_rng(seed)
+    background = np.zeros((480, 640, 3), dtype=np.uint8)
+    background[:] = np.linspace(60, 160, 640, dtype=np.uint8)[None, :, None]
+    cv2.putText(background, 'tank', (250, 400), cv2.FONT_HERSHEY_SIMPLEX, 3, (200, 220, 200), 5)
+    n = seconds * fps
+    frames = []
+    for i in range(n):
+        frame = np.clip(background + rng.normal(0, 2, background.shape), 0, 255).astype(np.uint8)
+        phase = (i % (5 * fps * 2)) / (5 * fps * 2)
+        if phase < 0.2:
+            x = int(40 + phase / 0.2 * 560)
+            cv2.ellipse(frame, (x, 200), (40, 15), 0, 0, 360, (30, 90, 230), -1)
+        frames.append(frame)
+    return np.arange(n) / fps, frames
+
+def play(times, frames, gate):
+    """Capture from the footage on a simulated clock. Returns counts, CPU
+    seconds and encoded bytes."""
+    captured = encoded = n_bytes = 0
+    cpu = 0.0
+    t = 0.0
+    last_publish = None
+    while t <= times[-1]:
+        frame = frames[np.searchsorted(times, t, side="right") - 1]
+        captured += 1
+        start = time.process_time()
+        keyframe_due = last_publish is None or t - last_publish >= KEYFRAME_INTERVAL
+        if gate is None or gate.update(frame, force=keyframe_due):
+            success, jpeg = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+            encoded += 1
+            n_bytes += len(jpeg)
+            last_publish = t
+        cpu += time.process_time() - start
+        t += FRAME_INTERVAL if gate is None else gate.interval
+    return captured, encoded, cpu, n_bytes
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark motion-gated capture on recorded footage.")
+    parser.add_argument("--video", help="ungated video file readable by OpenCV (default: synthetic footage)")
+    args = parser.parse_args()
+
+    if args.video:
+        times, frames = load_video(args.video)
+    else:
+        times, frames = synthetic_footage()
+    duration = times[-1]
+    print(f"{len(frames)} frames, {duration:.1f} s of footage")
+
+    results = {
+        "every frame": play(times, frames, None),
+        "motion gated": play(times, frames, MotionGate(min_interval=FRAME_INTERVAL)),
+    }
+    for name, (captured, encoded, cpu, n_bytes) in results.items():
+        print(f"  {name:<13} captured {captured / duration:5.1f}/s, encoded {encoded / duration:5.1f}/s, "
+              f"cpu {cpu / duration * 100:5.1f}%, sent {n_bytes / duration / 1024:7.1f} KiB/s")
+    base, gated = results["every frame"], results["motion gated"]
+    print(f"  cpu reduced by {(1 - gated[2] / base[2]) * 100:.0f}%, bandwidth by {(1 - gated[3] / base[3]) * 100:.0f}%")
+
+if __name__ == "__main__":
+    main()
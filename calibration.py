@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+from dataclasses import dataclass, field, asdict
+import numpy as np
+
+"""
+Calibration of the probes (pH, TDS, dissolved oxygen and flow).
+
+Each probe has a calibration class holding its coefficients. Invariant terms are
+computed once when the calibration is constructed, and `convert` accepts either
+a single voltage or a numpy array of voltages, so the same code is used for live
+readings and for batch reprocessing of stored raw voltages.
+
+Calibrations are stored in a JSON profile (see `CALIBRATION_PROFILE_PATH`) with
+one entry per probe. If there is no profile the calibration the system was
+originally shipped with is used. To recalibrate from measurements of reference
+solutions, run this module as a script, e.g.
+
+    python calibration.py ph 1.512:4.0 1.381:7.0 1.05:10.0
+
+which fits the pH probe to the given voltage:pH points and saves the profile.
+"""
+
+CALIBRATION_PROFILE_PATH = os.getenv("CALIBRATION_PROFILE_PATH", "calibration.json")
+
+# Water temperature in C used where no water temperature is known. We don't
+# have a water temperature sensor yet, so this is a dummy value.
+DEFAULT_WATER_TEMP = 25.6
+
+# Dissolved oxygen at saturation in ug/L for water temperatures 0 to 40 C in
+# steps of 1 C.
+DO_SATURATION_TABLE = [
+    14460, 14220, 13820, 13440, 13090, 12740, 12420, 12110, 11810, 11530,
+    11260, 11010, 10770, 10530, 10300, 10080, 9860, 9660, 9460, 9270,
+    9080, 8900, 8730, 8570, 8410, 8250, 8110, 7960, 7820, 7690,
+    7560, 7430, 7300, 7180, 7070, 6950, 6840, 6730, 6630, 6530, 6410,
+]
+
+def _tds_poly(voltage):
+    """Conductivity curve of the TDS probe, before scaling by the cell
+    constant."""
+    return 133.42 * voltage**3 - 255.86 * voltage**2 + 857.39 * voltage
+
+def _temp_compensation(temp):
+    """Conductivity changes by about 2% per degree C relative to 25 C."""
+    return 1 + 0.02 * (np.asarray(temp, dtype=float) - 25)
+
+@dataclass
+class PhCalibration:
+    """Linear pH probe: `voltage = neutral_voltage + inverse_slope * (pH - 7)`."""
+    neutral_voltage: float = 1.38102  # the voltage when the pH is 7
+    inverse_slope: float = -0.161711  # volts per pH unit
+
+    def convert(self, voltage):
+        """Get pH from probe voltage(s)."""
+        return (np.asarray(voltage, dtype=float) - self.neutral_voltage) / self.inverse_slope + 7.0
+
+    @classmethod
+    def fit(cls, points):
+        """Fit from two or more (voltage, pH) pairs measured in buffer
+        solutions."""
+        voltages, phs = np.asarray(points, dtype=float).T
+        if len(np.unique(phs)) < 2:
+            raise ValueError("pH calibration needs at least two different buffer solutions")
+        slope, intercept = np.polyfit(phs, voltages, 1)
+        return cls(neutral_voltage=float(slope * 7.0 + intercept), inverse_slope=float(slope))
+
+@dataclass
+class TdsCalibration:
+    """TDS probe, described by the cell constant `k` that scales the probe's
+    conductivity curve."""
+    k: float
+
+    def convert(self, voltage, water_temp=25):
+        """Get TDS in ppm from probe voltage(s) at the given water
+        temperature(s)."""
+        ec_raw = self.k * _tds_poly(np.asarray(voltage, dtype=float))
+        ec = ec_raw / _temp_compensation(water_temp)  # use current temp for temp compensation
+        return ec / 2  # TDS is just half of electrical conductivity in ppm
+
+    @classmethod
+    def fit(cls, points):
+        """Fit from one or more (voltage, EC at 25 C, water temperature)
+        triples measured in calibration solutions, by least squares."""
+        voltages, ecs, temps = np.asarray(points, dtype=float).T
+        raw_ecs = ecs * _temp_compensation(temps)  # temp compensate the calibrated values
+        poly = _tds_poly(voltages)
+        return cls(k=float(np.dot(poly, raw_ecs) / np.dot(poly, poly)))
+
+def _default_tds():
+    # calibrated with 342 ppm of aqueous NaCl (EC 684) at 23.25 C, reading
+    # 1.085751885 V; this will have to be readjusted for the solution in the
+    # tank
+    return TdsCalibration.fit([(1.085751885, 684, 23.25)])
+
+@dataclass
+class DoCalibration:
+    """
+    Dissolved oxygen probe. The probe voltage is proportional to the fraction
+    of saturation; the voltage at full saturation is `saturation_voltage` at
+    `calibration_temp` and changes by `saturation_slope` volts per degree C.
+    """
+    saturation_voltage: float = 0.81  # voltage when fully saturated
+    calibration_temp: float = 23.4  # temperature in C for above measurement
+    saturation_slope: float = 0.0
+    saturation_table: list = field(default_factory=lambda: list(DO_SATURATION_TABLE))
+
+    def __post_init__(self):
+        self._table = np.asarray(self.saturation_table, dtype=float)
+        self._table_temps = np.arange(len(self._table), dtype=float)
+
+    def convert(self, voltage, water_temp=DEFAULT_WATER_TEMP):
+        """Get dissolved oxygen in mg/L from probe voltage(s) at the given
+        water temperature(s)."""
+        water_temp = np.asarray(water_temp, dtype=float)
+        saturation_do = np.interp(water_temp, self._table_temps, self._table)
+        v_saturation = self.saturation_voltage + self.saturation_slope * (water_temp - self.calibration_temp)
+        return np.asarray(voltage, dtype=float) * saturation_do / v_saturation / 1000
+
+    @classmethod
+    def fit(cls, points):
+        """Fit from one or more (voltage, water temperature) pairs measured in
+        fully saturated water. With a single point the saturation voltage is
+        assumed not to depend on temperature."""
+        voltages, temps = np.asarray(points, dtype=float).T
+        calibration_temp = float(temps.mean())
+        if len(np.unique(temps)) < 2:
+            return cls(saturation_voltage=float(voltages.mean()), calibration_temp=calibration_temp)
+        slope, intercept = np.polyfit(temps, voltages, 1)
+        return cls(
+            saturation_voltage=float(slope * calibration_temp + intercept),
+            calibration_temp=calibration_temp,
+            saturation_slope=float(slope),
+        )
+
+@dataclass
+class FlowCalibration:
+    """Pulse output flow meter: the pulse frequency in Hz is `hz_per_lpm`
+    times the flow rate in liters per minute."""
+    hz_per_lpm: float = 0.2
+
+    def convert(self, pulses, seconds):
+        """Get flow rate in gallons per hour from pulse count(s) over the given
+        duration(s)."""
+        freq = np.asarray(pulses, dtype=float) / np.asarray(seconds, dtype=float)
+        return (freq / self.hz_per_lpm) * 15.850323141489  # liters per minute to gallons per hour
+
+    def volume(self, pulses):
+        """Get volume in gallons from pulse count(s)."""
+        liters = np.asarray(pulses, dtype=float) / (self.hz_per_lpm * 60)
+        return liters * 0.26417205235815  # liters to gallons
+
+    @classmethod
+    def fit(cls, points):
+        """Fit from one or more (pulse frequency in Hz, flow rate in liters per
+        minute) pairs, by least squares."""
+        freqs, flows = np.asarray(points, dtype=float).T
+        return cls(hz_per_lpm=float(np.dot(freqs, flows) / np.dot(flows, flows)))
+
+@dataclass
+class CalibrationProfile:
+    """Calibrations for all probes of one sensor group."""
+    ph: PhCalibration = field(default_factory=PhCalibration)
+    tds: TdsCalibration = field(default_factory=_default_tds)
+    do: DoCalibration = field(default_factory=DoCalibration)
+    flow: FlowCalibration = field(default_factory=FlowCalibration)
+
+    def convert_raw(self, raw):
+        """
+        Derive SensorData fields from raw readings. `raw` maps RawSensorData
+        field names to values or numpy arrays of values; the result maps
+        SensorData field names to arrays of the same shape.
+        """
+        return {
+            "unix_time": np.asarray(raw["unix_time"]),
+            "pH": self.ph.convert(raw["ph_voltage"]),
+            "flow": self.flow.convert(raw["flow_pulses"], raw["flow_seconds"]),
+            "air_temp": np.asarray(raw["air_temp"], dtype=float),
+            "humidity": np.asarray(raw["humidity"], dtype=float),
+            "TDS": self.tds.convert(raw["tds_voltage"]),
+            "dissolved_oxygen": self.do.convert(raw["do_voltage"]),
+        }
+
+def load_profile(path=None):
+    """Load a calibration profile. Probes missing from the file (or a missing
+    file) get the default calibration."""
+    path = path or CALIBRATION_PROFILE_PATH
+    if not os.path.exists(path):
+        return CalibrationProfile()
+    with open(path) as f:
+        data = json.load(f)
+    profile = CalibrationProfile()
+    if "ph" in data:
+        profile.ph = PhCalibration(**data["ph"])
+    if "tds" in data:
+        profile.tds = TdsCalibration(**data["tds"])
+    if "do" in data:
+        profile.do = DoCalibration(**data["do"])
+    if "flow" in data:
+        profile.flow = FlowCalibration(**data["flow"])
+    return profile
+
+def save_profile(profile, path=None):
+    """Save a calibration profile as JSON."""
+    path = path or CALIBRATION_PROFILE_PATH
+    with open(path, "w") as f:
+        json.dump(asdict(profile), f, indent=4)
+
+def _parse_points(points):
+    return [tuple(float(x) for x in point.split(":")) for point in points]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recalibrate a probe from reference measurements.")
+    parser.add_argument("--profile", default=CALIBRATION_PROFILE_PATH, help="calibration profile to update")
+    subparsers = parser.add_subparsers(dest="probe", required=True)
+    subparsers.add_parser("ph", help="points are VOLTAGE:PH").add_argument("points", nargs="+")
+    subparsers.add_parser("tds", help="points are VOLTAGE:EC:WATER_TEMP").add_argument("points", nargs="+")
+    subparsers.add_parser("do", help="points are VOLTAGE:WATER_TEMP at saturation").add_argument("points", nargs="+")
+    subparsers.add_parser("flow", help="points are PULSE_HZ:LITERS_PER_MINUTE").add_argument("points", nargs="+")
+    args = parser.parse_args(argv)
+
+    calibration_classes = {
+        "ph": PhCalibration,
+        "tds": TdsCalibration,
+        "do": DoCalibration,
+        "flow": FlowCalibration,
+    }
+    calibration_class = calibration_classes[args.probe]
+    profile = load_profile(args.profile)
+    calibration = calibration_class.fit(_parse_points(args.points))
+    setattr(profile, args.probe, calibration)
+    save_profile(profile, args.profile)
+    print(f"saved {args.probe} calibration to {args.profile}: {calibration}")
+
+if __name__ == "__main__":
+    main()
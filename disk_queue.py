@@ -0,0 +1,101 @@
+import os
+import pickle
+import struct
+import threading
+
+"""
+A persistent FIFO queue of picklable objects, stored in a single append-only
+file. Items stay on disk until they are dropped from the front of the queue, so
+nothing is lost if the process restarts in between. Memory use doesn't depend on
+the number of queued items.
+"""
+
+_LENGTH = struct.Struct("<I")
+_OFFSET = struct.Struct("<Q")
+
+class DiskQueue:
+    """
+    FIFO queue backed by the file at `path`. The position of the front of the
+    queue is kept in `path + ".offset"`; once the queue is empty the data file
+    is truncated.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = path + ".offset"
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        self.read_offset = 0
+        if os.path.exists(self.offset_path):
+            with open(self.offset_path, "rb") as f:
+                buf = f.read()
+            if len(buf) == _OFFSET.size:
+                self.read_offset = _OFFSET.unpack(buf)[0]
+
+        # count the pending items, ignoring a partially written last record
+        self.count = 0
+        self.end_offset = self.read_offset
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                f.seek(self.read_offset)
+                while len(header := f.read(_LENGTH.size)) == _LENGTH.size:
+                    length = _LENGTH.unpack(header)[0]
+                    if len(f.read(length)) < length:
+                        break
+                    self.count += 1
+                    self.end_offset += _LENGTH.size + length
+        self.file = open(path, "ab")
+        self.file.truncate(self.end_offset)
+
+    def __len__(self):
+        return self.count
+
+    def put(self, item):
+        """Add an item to the back of the queue."""
+        data = pickle.dumps(item)
+        with self.lock:
+            self.file.write(_LENGTH.pack(len(data)) + data)
+            self.file.flush()
+            self.end_offset += _LENGTH.size + len(data)
+            self.count += 1
+
+    def peek(self, n=1):
+        """Return up to n items from the front of the queue without removing
+        them."""
+        items = []
+        with self.lock, open(self.path, "rb") as f:
+            f.seek(self.read_offset)
+            while len(items) < min(n, self.count):
+                length = _LENGTH.unpack(f.read(_LENGTH.size))[0]
+                items.append(pickle.loads(f.read(length)))
+        return items
+
+    def drop(self, n=1):
+        """Remove up to n items from the front of the queue."""
+        with self.lock:
+            with open(self.path, "rb") as f:
+                f.seek(self.read_offset)
+                for _ in range(min(n, self.count)):
+                    length = _LENGTH.unpack(f.read(_LENGTH.size))[0]
+                    f.seek(length, os.SEEK_CUR)
+                    self.read_offset += _LENGTH.size + length
+                    self.count -= 1
+            if self.count == 0:
+                # reclaim the space once everything has been consumed
+                self.file.truncate(0)
+                self.read_offset = self.end_offset = 0
+            with open(self.offset_path, "wb") as f:
+                f.write(_OFFSET.pack(self.read_offset))
+
+    def get(self):
+        """Remove and return the item at the front of the queue, or None if it
+        is empty."""
+        items = self.peek(1)
+        if items:
+            self.drop(1)
+            return items[0]
+        return None
+
+    def close(self):
+        self.file.close()
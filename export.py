@@ -0,0 +1,41 @@
+import argparse
+import sys
+from history import HISTORY_DIR, HistoryStore, parse_time, write_export
+from tanks import find_tank, load_tanks
+
+"""
+Command line tool for exporting locally stored sensor history.
+
+Example: export the pH and TDS readings for 2024 to a file.
+
+    python export.py --start 2024-01-01 --end 2025-01-01 --fields pH,TDS -o 2024.npz
+
+With several tanks configured (see tanks.py), pick one with `--tank`.
+
+Load the result with `history.read_export`.
+"""
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export sensor history as a compressed columnar archive.")
+    parser.add_argument("--start", help="first time to include (unix seconds or ISO date)")
+    parser.add_argument("--end", help="time to stop before (unix seconds or ISO date)")
+    parser.add_argument("--fields", help="comma separated list of fields (default: all)")
+    parser.add_argument("--tank", help="tank to export (default: the first configured tank)")
+    parser.add_argument("--dir", help=f"history directory (default: the tank's directory in {HISTORY_DIR})")
+    parser.add_argument("-o", "--output", required=True, help="output file, or - for stdout")
+    args = parser.parse_args(argv)
+
+    tank = find_tank(load_tanks(), args.tank)
+    store = HistoryStore(args.dir or tank.data_dir(HISTORY_DIR))
+    field_names = args.fields.split(",") if args.fields else None
+    columns = store.read(parse_time(args.start), parse_time(args.end), field_names)
+
+    if args.output == "-":
+        write_export(columns, sys.stdout.buffer)
+    else:
+        with open(args.output, "wb") as f:
+            write_export(columns, f)
+    print(f"exported {len(columns['unix_time'])} samples", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+import copy
+import queue
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any
+
+"""
+An in-process stand-in for Firestore, for running and load testing the Firebase
+actor without service credentials (set `FIREBASE_BACKEND=fake`).
+
+It implements the parts of the Firestore client API the actor uses:
+collections and documents, `add`, `set`, `where` with `FieldFilter`,
+`order_by`, `limit`, `get`/`stream`, batched writes and `on_snapshot`
+listeners. Like the real client, snapshot callbacks run on a separate thread,
+first with the current results and then whenever the results change.
+
+To exercise latency and outages, every request can be delayed by `latency`
+seconds, and `set_online(False)` makes every request fail with a
+ConnectionError until it is set back online.
+"""
+
+ASCENDING = "ASCENDING"
+DESCENDING = "DESCENDING"
+
+# maximum number of writes in one batch, as in Firestore
+MAX_BATCH_SIZE = 500
+
+_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "in": lambda a, b: a in b,
+    "not-in": lambda a, b: a not in b,
+    "array_contains": lambda a, b: isinstance(a, list) and b in a,
+    "array-contains": lambda a, b: isinstance(a, list) and b in a,
+}
+
+@dataclass
+class FieldFilter:
+    """A filter on one field, as in `google.cloud.firestore.FieldFilter`."""
+    field_path: str
+    op_string: str
+    value: Any
+
+    def matches(self, data):
+        return _OPERATORS[self.op_string](data.get(self.field_path), self.value)
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, read_time):
+        self.reference = reference
+        self.id = reference.id
+        self.read_time = read_time
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path):
+        return self._data[field_path]
+
+@dataclass
+class DocumentChange:
+    type: str  # "ADDED", "MODIFIED" or "REMOVED"
+    document: DocumentSnapshot
+    old_index: int
+    new_index: int
+
+class DocumentReference:
+    def __init__(self, client, collection_name, doc_id):
+        self._client = client
+        self.collection_name = collection_name
+        self.id = doc_id
+
+    @property
+    def path(self):
+        return f"{self.collection_name}/{self.id}"
+
+    def get(self, timeout=None):
+        self._client._request()
+        with self._client.lock:
+            data = self._client.collections.get(self.collection_name, {}).get(self.id)
+        return DocumentSnapshot(self, copy.deepcopy(data), time.time())
+
+    def set(self, document_data, merge=False, timeout=None):
+        batch = self._client.batch()
+        batch.set(self, document_data, merge=merge)
+        return batch.commit()[0]
+
+    def update(self, field_updates, timeout=None):
+        batch = self._client.batch()
+        batch.update(self, field_updates)
+        return batch.commit()[0]
+
+    def delete(self, timeout=None):
+        batch = self._client.batch()
+        batch.delete(self)
+        batch.commit()
+
+class Query:
+    def __init__(self, client, collection_name, filters=(), orders=(), limit_to=None):
+        self._client = client
+        self.collection_name = collection_name
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit_to
+
+    def _copy(self, **changes):
+        args = dict(filters=self._filters, orders=self._orders, limit_to=self._limit)
+        args.update(changes)
+        return Query(self._client, self.collection_name, **args)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is None:
+            filter = FieldFilter(field_path, op_string, value)
+        return self._copy(filters=self._filters + (filter,))
+
+    def order_by(self, field_path, direction=ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit_to=count)
+
+    def _matches(self, data):
+        # like Firestore, ordering by a field excludes documents without it
+        return (all(f.matches(data) for f in self._filters)
+                and all(field in data for field, _ in self._orders))
+
+    def _sort(self, items):
+        """Sort (id, data) pairs in query order, ties broken by id."""
+        items = sorted(items, key=lambda item: item[0])
+        for field, direction in reversed(self._orders):
+            items.sort(key=lambda item: item[1][field], reverse=direction == DESCENDING)
+        return items
+
+    def _run(self, documents):
+        """Evaluate the query over a {id: data} mapping; returns sorted (id,
+        data) pairs."""
+        items = self._sort((doc_id, data) for doc_id, data in documents.items() if self._matches(data))
+        return items if self._limit is None else items[:self._limit]
+
+    def _snapshots(self, items, read_time):
+        return [
+            DocumentSnapshot(DocumentReference(self._client, self.collection_name, doc_id), copy.deepcopy(data), read_time)
+            for doc_id, data in items
+        ]
+
+    def get(self, transaction=None, timeout=None):
+        self._client._request()
+        with self._client.lock:
+            items = self._run(self._client.collections.get(self.collection_name, {}))
+            return self._snapshots(items, time.time())
+
+    def stream(self, transaction=None, timeout=None):
+        return iter(self.get(timeout=timeout))
+
+    def on_snapshot(self, callback):
+        self._client._request()
+        return Watch(self, callback)
+
+class CollectionReference(Query):
+    def __init__(self, client, name):
+        super().__init__(client, name)
+        self.id = name
+
+    def document(self, document_id=None):
+        return DocumentReference(self._client, self.collection_name, document_id or uuid.uuid4().hex[:20])
+
+    def add(self, document_data, document_id=None, timeout=None):
+        doc_ref = self.document(document_id)
+        update_time = doc_ref.set(document_data)
+        return update_time, doc_ref
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(("set_merge" if merge else "set", reference, copy.deepcopy(document_data)))
+
+    def create(self, reference, document_data):
+        self._writes.append(("create", reference, copy.deepcopy(document_data)))
+
+    def update(self, reference, field_updates):
+        self._writes.append(("update", reference, copy.deepcopy(field_updates)))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference, None))
+
+    def commit(self, timeout=None):
+        """Apply all writes atomically. Returns one write time per write."""
+        if len(self._writes) > MAX_BATCH_SIZE:
+            raise ValueError(f"maximum {MAX_BATCH_SIZE} writes allowed per batch")
+        self._client._request()
+        self._client._apply(self._writes)
+        write_times = [time.time()] * len(self._writes)
+        self._writes = []
+        return write_times
+
+class Watch:
+    """A snapshot listener on a query. Callbacks run on the watch's own
+    thread, in order."""
+
+    def __init__(self, query, callback):
+        self.query = query
+        self.callback = callback
+        self.events = queue.Queue()
+        self.results = None
+        self.active = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        client = query._client
+        with client.lock:
+            client.watches.append(self)
+            self._update(client.collections.get(query.collection_name, {}), changed_ids=None)
+        self.thread.start()
+
+    def _update(self, documents, changed_ids):
+        """Re-evaluate the query after the given documents changed (None for
+        all) and queue a snapshot if the results differ. Called with the
+        client lock held."""
+        query = self.query
+        if changed_ids is None or self.results is None:
+            new_results = query._run(documents)
+        else:
+            # only the current results and the changed documents can be in
+            # the new results, unless a result of a limited query changed, in
+            # which case some other document may move up
+            current_ids = {doc_id for doc_id, _ in self.results}
+            if query._limit is not None and changed_ids & current_ids:
+                new_results = query._run(documents)
+            else:
+                candidates = {doc_id: data for doc_id, data in self.results}
+                for doc_id in changed_ids:
+                    if doc_id in documents:
+                        candidates[doc_id] = documents[doc_id]
+                    else:
+                        candidates.pop(doc_id, None)
+                new_results = query._run(candidates)
+
+        if self.results is not None and new_results == self.results:
+            return
+        changes = self._changes(self.results or [], new_results)
+        self.results = new_results
+        read_time = time.time()
+        self.events.put((query._snapshots(new_results, read_time), changes, read_time))
+
+    def _changes(self, old, new):
+        old_index = {doc_id: (i, data) for i, (doc_id, data) in enumerate(old)}
+        new_index = {doc_id: (i, data) for i, (doc_id, data) in enumerate(new)}
+        read_time = time.time()
+        client, name = self.query._client, self.query.collection_name
+        changes = []
+        for doc_id, (i, data) in old_index.items():
+            if doc_id not in new_index:
+                snapshot = DocumentSnapshot(DocumentReference(client, name, doc_id), copy.deepcopy(data), read_time)
+                changes.append(DocumentChange("REMOVED", snapshot, i, -1))
+        for doc_id, (i, data) in new_index.items():
+            snapshot = DocumentSnapshot(DocumentReference(client, name, doc_id), copy.deepcopy(data), read_time)
+            if doc_id not in old_index:
+                changes.append(DocumentChange("ADDED", snapshot, -1, i))
+            elif old_index[doc_id][1] != data:
+                changes.append(DocumentChange("MODIFIED", snapshot, old_index[doc_id][0], i))
+        return changes
+
+    def _run(self):
+        while (event := self.events.get()) is not None:
+            if self.active:
+                try:
+                    self.callback(*event)
+                except Exception:
+                    # like the real client, a failing callback doesn't stop
+                    # the watch
+                    pass
+
+    def unsubscribe(self):
+        self.active = False
+        client = self.query._client
+        with client.lock:
+            if self in client.watches:
+                client.watches.remove(self)
+        self.events.put(None)
+
+class FakeFirestoreClient:
+    """In-memory Firestore client. All data lives in `collections`, a
+    {collection name: {document id: data}} mapping."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.online = True
+        self.lock = threading.RLock()
+        self.collections = {}
+        self.watches = []
+        self.request_count = 0
+
+    def set_online(self, online):
+        self.online = online
+
+    def _request(self):
+        """Account for one round trip to the server."""
+        if not self.online:
+            raise ConnectionError("fake Firestore is offline")
+        self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def _validate(self, writes):
+        """Check that every write can be applied, taking earlier writes in
+        the same batch into account. Called with the lock held, before
+        anything is changed, so that a failing batch changes nothing."""
+        exists = {}
+        for kind, reference, _ in writes:
+            key = (reference.collection_name, reference.id)
+            if key not in exists:
+                exists[key] = reference.id in self.collections.get(reference.collection_name, {})
+            if kind == "create" and exists[key]:
+                raise ValueError(f"document {reference.path} already exists")
+            if kind == "update" and not exists[key]:
+                raise ValueError(f"no document to update: {reference.path}")
+            exists[key] = kind != "delete"
+
+    def _apply(self, writes):
+        with self.lock:
+            self._validate(writes)
+            changed = {}
+            for kind, reference, data in writes:
+                documents = self.collections.setdefault(reference.collection_name, {})
+                current = documents.get(reference.id)
+                if kind in ("set", "create"):
+                    documents[reference.id] = data
+                elif kind == "set_merge":
+                    documents[reference.id] = {**(current or {}), **data}
+                elif kind == "update":
+                    documents[reference.id] = {**current, **data}
+                elif kind == "delete":
+                    documents.pop(reference.id, None)
+                changed.setdefault(reference.collection_name, set()).add(reference.id)
+
+            for watch in self.watches:
+                name = watch.query.collection_name
+                if name in changed:
+                    watch._update(self.collections[name], changed[name])
+
+    def close(self):
+        for watch in list(self.watches):
+            watch.unsubscribe()
+
+class FakeFirestoreBackend:
+    """Backend for the Firebase actor (see firestore_backend.py) using a
+    FakeFirestoreClient."""
+
+    DESCENDING = DESCENDING
+    FieldFilter = FieldFilter
+
+    def __init__(self, latency=0.0):
+        self.client = FakeFirestoreClient(latency=latency)
+
+    def connect(self):
+        self.client._request()
+        return self.client
+
+    def shutdown(self):
+        pass
+
+_shared_backend = None
+
+def shared_backend():
+    """The process-wide fake backend, so data survives restarts of the
+    Firebase actor like it would in the real Firestore."""
+    global _shared_backend
+    if _shared_backend is None:
+        _shared_backend = FakeFirestoreBackend()
+    return _shared_backend
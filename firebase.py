@@ -1,18 +1,51 @@
 import os
-import firebase_admin
-from firebase_admin import credentials, firestore
+import threading
+import uuid
 import pykka
 from logs import register_logger
-from dataclasses import dataclass
-from typing import Any
+from dataclasses import asdict, dataclass
+from typing import Any, Optional
 from sensors_data import SensorData
+from actor_mailbox import BoundedMailboxMixin, SPILL
+from disk_queue import DiskQueue
+from tanks import DEFAULT_TANK_ID
 
 firebase_logger = register_logger("logs/firebase.log", "Firebase")
 
+# sensor data is queued here until it has been written to Firestore
+OUTBOX_PATH = os.getenv("FIREBASE_OUTBOX_PATH", "data/outbox/stats.queue")
+
+# seconds to wait between reconnection attempts while offline; doubles after
+# every failed attempt up to the maximum
+RECONNECT_DELAY = 5
+MAX_RECONNECT_DELAY = 300
+
+# timeout in seconds for requests to Firestore
+REQUEST_TIMEOUT = 15
+
+# maximum number of writes in one Firestore batch
+BATCH_SIZE = 500
+
+# storage backend: "firestore" for the real thing, or "fake" for an in-process
+# stand-in for testing without credentials (see fake_firestore.py)
+FIREBASE_BACKEND = os.getenv("FIREBASE_BACKEND", "firestore")
+
+def make_backend(name=FIREBASE_BACKEND, logger=firebase_logger):
+    """Create the storage backend with the given name."""
+    if name == "firestore":
+        from firestore_backend import FirestoreBackend
+        return FirestoreBackend(logger)
+    if name == "fake":
+        from fake_firestore import shared_backend
+        return shared_backend()
+    raise ValueError(f"unknown Firebase backend {name!r}")
+
 @dataclass
 class GetTolerances:
-    """Message to request tolerances from Firebase."""
-    pass
+    """Message to request tolerances from Firebase. With a tank ID, the
+    tank's own tolerances (in `tanks/<tank_id>/tolerances`) take precedence
+    over the shared ones."""
+    tank_id: Optional[str] = None
 
 @dataclass
 class GetNotificationRecipients:
@@ -35,47 +68,67 @@ class AddSensorData:
     """Message to add sensor data to Firebase."""
     data: SensorData
 
+@dataclass
+class Reconnect:
+    """Message to make an offline Firebase actor try to connect again."""
+    pass
+
 @dataclass
 class StatsUpdate:
     """Message containing updated stats data."""
     data: dict[str, Any]
 
-class Firebase(pykka.ThreadingActor):
-    def __init__(self, firebase_logger=firebase_logger):
+class Firebase(BoundedMailboxMixin, pykka.ThreadingActor):
+    """
+    This actor manages all interactions with Firestore. It works offline
+    first: if Firestore can't be reached, the actor still starts, serves
+    tolerances and recipients from its last known copy, and keeps sensor data
+    in a local outbox. It retries connecting with exponential backoff, and on
+    reconnection uploads the outbox and re-establishes its listeners.
+
+    A single actor serves all tanks: sensor data from every tank shares the
+    outbox and upload batches, and stats subscribers get the latest sample of
+    each tank.
+    """
+
+    # sensor data waiting to be uploaded goes to disk rather than piling up
+    # in memory if Firestore is slow or unreachable
+    mailbox_messages = (AddSensorData,)
+    mailbox_size = 100
+    mailbox_policy = SPILL
+    mailbox_logger = firebase_logger
+
+    def __init__(self, firebase_logger=firebase_logger, backend=None, tank_ids=None):
         super().__init__()
         self.firebase_logger = firebase_logger
+        self.backend = backend
+        self.tank_ids = tank_ids or [DEFAULT_TANK_ID]
         self.db = None
+        self.online = False
         self.stats_listeners = set()
-        self.watch = None
+        self.watches = []
+        self.outbox = DiskQueue(OUTBOX_PATH)
 
-    def on_start(self):
-        try:
-            self.firebase_logger.info("Initializing Firebase")
+        # latest copies of data from Firestore, kept up to date by listeners
+        self.tolerances = None
+        self.tank_tolerances = {}
+        self.recipients = None
 
-            try:
-                firebase_admin.get_app()
-                self.firebase_logger.info("Firebase already initialized, using existing app instance")
-            except ValueError:
-                self.firebase_logger.info("Firebase not initialized, initializing new app instance")
-                service_account_path = os.getenv('FIREBASE_SERVICE_ACCOUNT_KEY_PATH')
-                if not service_account_path:
-                    raise ValueError("FIREBASE_SERVICE_ACCOUNT_KEY_PATH environment variable not set")
-                cred = credentials.Certificate(service_account_path)
-                firebase_admin.initialize_app(cred)
-
-            self.db = firestore.client()
-            self._setup_stats_listener()
-            self.firebase_logger.info("Firebase initialized successfully")
-        except Exception as e:
-            self.firebase_logger.error(f"Error initializing Firebase: {e}")
-            raise e
+        self.reconnect_delay = RECONNECT_DELAY
+        self.reconnect_timer = None
+
+    def on_start(self):
+        self.firebase_logger.info("Initializing Firebase")
+        if len(self.outbox):
+            self.firebase_logger.info(f"{len(self.outbox)} sensor data entries waiting to be uploaded")
+        self.connect()
 
     def on_receive(self, message):
         self.firebase_logger.debug(f"Received message: {message}")
 
         if isinstance(message, GetTolerances):
             self.firebase_logger.debug("Getting tolerances")
-            return self.get_tolerances()
+            return self.get_tolerances(message.tank_id)
         elif isinstance(message, GetNotificationRecipients):
             self.firebase_logger.debug("Getting notification recipients")
             return self.get_notification_recipients()
@@ -90,6 +143,10 @@ class Firebase(pykka.ThreadingActor):
         elif isinstance(message, AddSensorData):
             self.firebase_logger.debug("Adding sensor data")
             return self.add_sensor_data(message.data)
+        elif isinstance(message, Reconnect):
+            if not self.online:
+                self.connect()
+            return
 
         self.firebase_logger.warning(f"Received unknown message type: {type(message)}")
 
@@ -102,19 +159,95 @@ class Firebase(pykka.ThreadingActor):
 
     def shut_down_firebase(self):
         self.firebase_logger.info("Shutting down Firebase connection")
-        if self.watch:
-            self.watch.unsubscribe()
+        if self.reconnect_timer:
+            self.reconnect_timer.cancel()
+        self._unsubscribe_listeners()
+        self.outbox.close()
         try:
-            firebase_admin.delete_app(firebase_admin.get_app())
+            if self.backend:
+                self.backend.shutdown()
             self.firebase_logger.info("Firebase connection shut down successfully")
         except Exception as e:
             self.firebase_logger.error(f"Error shutting down Firebase connection: {e}")
 
+    # connection management
+
+    def connect(self):
+        """Try to connect to Firestore. On success, upload queued data and set
+        up listeners; on failure, go offline and schedule another attempt."""
+        try:
+            if self.backend is None:
+                self.backend = make_backend(logger=self.firebase_logger)
+            self.db = self.backend.connect()
+
+            # the client connects lazily, so make a small request to find out
+            # whether Firestore is actually reachable
+            self.db.collection('tolerances').limit(1).get(timeout=REQUEST_TIMEOUT)
+            self._setup_listeners()
+        except Exception as e:
+            self.go_offline(f"Error connecting to Firebase: {e}")
+            return
+
+        self.online = True
+        self.reconnect_delay = RECONNECT_DELAY
+        self.firebase_logger.info("Firebase initialized successfully")
+        self.flush_outbox()
+
+    def go_offline(self, reason):
+        """Switch to offline mode and schedule a reconnection attempt."""
+        self.firebase_logger.warning(f"{reason}; working offline, retrying in {self.reconnect_delay} seconds")
+        self.online = False
+        self._unsubscribe_listeners()
+
+        if self.reconnect_timer:
+            self.reconnect_timer.cancel()
+        actor_ref = self.actor_ref
+        self.reconnect_timer = threading.Timer(
+            self.reconnect_delay,
+            lambda: actor_ref.tell(Reconnect()) if actor_ref.is_alive() else None,
+        )
+        self.reconnect_timer.daemon = True
+        self.reconnect_timer.start()
+        self.reconnect_delay = min(self.reconnect_delay * 2, MAX_RECONNECT_DELAY)
+
+    def _setup_listeners(self):
+        """Set up listeners for stats, tolerances and notification
+        recipients."""
+        self._unsubscribe_listeners()
+        self._setup_stats_listener()
+        self.watches.append(self.db.collection('tolerances').on_snapshot(self._handle_tolerances_update))
+        for tank_id in self.tank_ids:
+            callback = lambda docs, changes, read_time, tank_id=tank_id: \
+                self._handle_tank_tolerances_update(tank_id, docs)
+            self.watches.append(self.db.collection(f'tanks/{tank_id}/tolerances').on_snapshot(callback))
+        users_ref = self.db.collection('users')
+        query = users_ref.where(filter=self.backend.FieldFilter("email_notifications", "==", True))
+        self.watches.append(query.on_snapshot(self._handle_recipients_update))
+
+    def _unsubscribe_listeners(self):
+        for watch in self.watches:
+            try:
+                watch.unsubscribe()
+            except Exception as e:
+                self.firebase_logger.warning(f"Error removing listener: {e}")
+        self.watches = []
+
     def _setup_stats_listener(self):
         """Set up a listener for stats collection changes."""
         stats_ref = self.db.collection('stats')
-        query = stats_ref.order_by("unix_time", direction=firestore.Query.DESCENDING).limit(1)
-        self.watch = query.on_snapshot(self._handle_stats_update)
+        if len(self.tank_ids) == 1:
+            query = stats_ref.order_by("unix_time", direction=self.backend.DESCENDING).limit(1)
+            self.watches.append(query.on_snapshot(self._handle_stats_update))
+            return
+
+        # the latest sample of each tank; these queries need a composite
+        # index on (tank_id, unix_time descending) in Firestore
+        for tank_id in self.tank_ids:
+            query = (stats_ref
+                     .where(filter=self.backend.FieldFilter("tank_id", "==", tank_id))
+                     .order_by("unix_time", direction=self.backend.DESCENDING)
+                     .limit(1))
+            self.watches.append(query.on_snapshot(self._handle_stats_update))
 
     def _handle_stats_update(self, doc_snapshot, changes, read_time):
         """Handle real-time updates to sensor data and notify subscribers."""
@@ -122,16 +255,38 @@ class Firebase(pykka.ThreadingActor):
             sensor_data = doc.to_dict()
             self.firebase_logger.debug(f"New sensor data received: {sensor_data}")
             # Notify all subscribers
-            for listener in self.stats_listeners:
+            for listener in list(self.stats_listeners):
                 listener.tell(StatsUpdate(data=sensor_data))
 
-    def get_tolerances(self):
-        """Retrieve tolerances from Firebase."""
-        tolerances = {}
-        tolerances_ref = self.db.collection('tolerances')
-        docs = tolerances_ref.stream()
-        for doc in docs:
-            tolerances[doc.id] = doc.to_dict()
+    def _handle_tolerances_update(self, doc_snapshot, changes, read_time):
+        """Keep the local copy of the tolerances up to date."""
+        self.tolerances = {doc.id: doc.to_dict() for doc in doc_snapshot}
+        self.firebase_logger.debug(f"Tolerances updated: {self.tolerances}")
+
+    def _handle_tank_tolerances_update(self, tank_id, doc_snapshot):
+        """Keep the local copy of a tank's own tolerances up to date."""
+        self.tank_tolerances[tank_id] = {doc.id: doc.to_dict() for doc in doc_snapshot}
+        self.firebase_logger.debug(f"Tolerances of tank {tank_id} updated: {self.tank_tolerances[tank_id]}")
+
+    def _handle_recipients_update(self, doc_snapshot, changes, read_time):
+        """Keep the local copy of the notification recipients up to date."""
+        self.recipients = [doc.to_dict()['email'] for doc in doc_snapshot]
+        self.firebase_logger.debug(f"Notification recipients updated: {self.recipients}")
+
+    # data access
+
+    def get_tolerances(self, tank_id=None):
+        """Retrieve tolerances from Firebase, or the last known tolerances
+        while offline. With a tank ID, the tank's own tolerances override the
+        shared ones field by field."""
+        tolerances = self.tolerances
+        if tolerances is None and self.online:
+            try:
+                tolerances = {doc.id: doc.to_dict() for doc in self.db.collection('tolerances').stream()}
+            except Exception as e:
+                self.firebase_logger.warning(f"Error retrieving tolerances: {e}")
+        if tank_id is not None and self.tank_tolerances.get(tank_id):
+            tolerances = {**(tolerances or {}), **self.tank_tolerances[tank_id]}
         if tolerances:
             self.firebase_logger.debug(f"Retrieved tolerances: {tolerances}")
             return tolerances
@@ -140,16 +295,53 @@ class Firebase(pykka.ThreadingActor):
             return {}
 
     def get_notification_recipients(self):
-        """Retrieve users who have opted in for email notifications."""
-        users_ref = self.db.collection('users')
-        query = users_ref.where(filter=firestore.FieldFilter("email_notifications", "==", True))
-        recipients = [user.to_dict()['email'] for user in query.stream()]
+        """Retrieve users who have opted in for email notifications, or the
+        last known recipients while offline."""
+        recipients = self.recipients
+        if recipients is None and self.online:
+            try:
+                users_ref = self.db.collection('users')
+                query = users_ref.where(filter=self.backend.FieldFilter("email_notifications", "==", True))
+                recipients = [user.to_dict()['email'] for user in query.stream()]
+            except Exception as e:
+                self.firebase_logger.warning(f"Error retrieving notification recipients: {e}")
+        recipients = recipients or []
         self.firebase_logger.debug(f"Notification recipients: {recipients}")
         return recipients
 
     def add_sensor_data(self, data: SensorData):
-        """Add sensor data to Firestore."""
-        data_dict = data.__dict__
-        doc_ref = self.db.collection('stats').add(data_dict)
-        doc_id = doc_ref[1].id
-        self.firebase_logger.debug(f"Added sensor data with id {doc_id}: {data_dict}")
+        """Queue sensor data for Firestore and upload it if online."""
+        # the document ID is chosen once, when the sample is queued, so if a
+        # commit went through but its reply was lost, uploading the batch
+        # again overwrites rather than duplicates it; the random part keeps
+        # samples taken in the same second apart
+        doc_id = f"{data.tank_id}_{data.unix_time}_{uuid.uuid4().hex[:8]}"
+        self.outbox.put((doc_id, data))
+        if self.online:
+            # if more sensor data is already waiting in the mailbox, upload it
+            # all together in one batch once the last of it has been queued
+            if self.actor_inbox.pending() == 0 or len(self.outbox) >= BATCH_SIZE:
+                self.flush_outbox()
+        else:
+            self.firebase_logger.debug(f"Offline, queued sensor data ({len(self.outbox)} waiting): {data}")
+
+    def flush_outbox(self):
+        """Upload queued sensor data in batches, oldest first. Data is only
+        removed from the outbox once its batch has been committed."""
+        if len(self.outbox) > 1:
+            self.firebase_logger.info(f"Uploading {len(self.outbox)} queued sensor data entries")
+        while len(self.outbox):
+            entries = self.outbox.peek(BATCH_SIZE)
+            try:
+                stats_ref = self.db.collection('stats')
+                batch = self.db.batch()
+                for entry in entries:
+                    # entries queued by older versions are bare SensorData
+                    doc_id, data = entry if isinstance(entry, tuple) else (f"{entry.tank_id}_{entry.unix_time}", entry)
+                    batch.set(stats_ref.document(doc_id), asdict(data))
+                batch.commit(timeout=REQUEST_TIMEOUT)
+            except Exception as e:
+                self.go_offline(f"Error uploading sensor data: {e}")
+                return
+            self.outbox.drop(len(entries))
+            self.firebase_logger.debug(f"Added {len(entries)} sensor data entries")
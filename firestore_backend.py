@@ -0,0 +1,41 @@
+import os
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+"""
+Storage backend for the Firebase actor that talks to the real Firestore through
+firebase_admin. See firebase.py for how a backend is chosen, and
+fake_firestore.py for the in-process stand-in with the same interface.
+
+A backend provides:
+    - `connect()`: return a Firestore client (raises if that isn't possible)
+    - `shutdown()`: release the connection
+    - `DESCENDING`: sort direction for `Query.order_by`
+    - `FieldFilter`: filter class for `Query.where(filter=...)`
+"""
+
+class FirestoreBackend:
+    """The real Firestore, authenticated with the service account key at
+    `FIREBASE_SERVICE_ACCOUNT_KEY_PATH`."""
+
+    DESCENDING = firestore.Query.DESCENDING
+    FieldFilter = firestore.FieldFilter
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def connect(self):
+        try:
+            firebase_admin.get_app()
+            self.logger.info("Firebase already initialized, using existing app instance")
+        except ValueError:
+            self.logger.info("Firebase not initialized, initializing new app instance")
+            service_account_path = os.getenv('FIREBASE_SERVICE_ACCOUNT_KEY_PATH')
+            if not service_account_path:
+                raise ValueError("FIREBASE_SERVICE_ACCOUNT_KEY_PATH environment variable not set")
+            cred = credentials.Certificate(service_account_path)
+            firebase_admin.initialize_app(cred)
+        return firestore.client()
+
+    def shutdown(self):
+        firebase_admin.delete_app(firebase_admin.get_app())
@@ -0,0 +1,149 @@
+import threading
+import time
+import numpy as np
+import lgpio as GPIO
+
+"""
+Continuous flow metering.
+
+The flow meter outputs one pulse per fixed volume of water. `FlowMeter` keeps an
+edge callback registered for as long as it runs and records the time of every
+pulse in a ring buffer, so flow can be queried at any time without blocking and
+without missing pulses between measurements.
+"""
+
+class FlowMeter:
+    """
+    Counts flow meter pulses on a GPIO pin in the background. The most recent
+    `capacity` pulse times are kept for rate queries; the total pulse count is
+    kept for the lifetime of the meter.
+    """
+
+    def __init__(self, gpio, flow_pin, calibration, capacity=1 << 16):
+        self.gpio = gpio
+        self.flow_pin = flow_pin
+        self.calibration = calibration
+        self.capacity = capacity
+
+        # pulse times in nanoseconds on the time.monotonic_ns() clock; pulse i
+        # is stored at index i % capacity
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.pulse_count = 0
+        self.start_ns = None
+        self.lock = threading.Lock()
+        self.callback = None
+
+        # pulse count and time of the previous sample (see pulses_since_sample)
+        self.sample_count = 0
+        self.sample_ns = None
+
+    def start(self):
+        """Start counting pulses."""
+        self.start_ns = time.monotonic_ns()
+        self.sample_ns = self.start_ns
+        self.callback = GPIO.callback(self.gpio, self.flow_pin, GPIO.FALLING_EDGE, self._on_edge)
+
+    def stop(self):
+        """Stop counting pulses."""
+        if self.callback is not None:
+            self.callback.cancel()
+            self.callback = None
+
+    def _on_edge(self, chip, gpio, level, timestamp):
+        # level 2 means a watchdog timeout rather than an edge
+        if level == 2:
+            return
+        # the timestamp lgpio passes is on a kernel dependent clock (since the
+        # epoch on older kernels, since boot on newer ones), so read our own
+        # clock to compare pulse times against
+        now_ns = time.monotonic_ns()
+        with self.lock:
+            self.timestamps[self.pulse_count % self.capacity] = now_ns
+            self.pulse_count += 1
+
+    def _recent(self):
+        """Buffered pulse times, oldest first, and whether older pulses have
+        been overwritten."""
+        with self.lock:
+            n = min(self.pulse_count, self.capacity)
+            indices = (self.pulse_count - n + np.arange(n)) % self.capacity
+            return self.timestamps[indices], self.pulse_count > self.capacity
+
+    def pulses_in_window(self, seconds):
+        """
+        Count pulses in the last `seconds` seconds. Returns the count and the
+        duration it covers, which is shorter than requested if the meter has
+        not been running that long or the buffer doesn't reach back that far.
+        """
+        now_ns = time.monotonic_ns()
+        window_start_ns = max(now_ns - int(seconds * 1e9), self.start_ns)
+        timestamps, overflowed = self._recent()
+        if overflowed and len(timestamps) and timestamps[0] > window_start_ns:
+            window_start_ns = int(timestamps[0])
+        first = np.searchsorted(timestamps, window_start_ns)
+        return int(len(timestamps) - first), (now_ns - window_start_ns) / 1e9
+
+    def pulses_since_sample(self):
+        """
+        Count pulses since the previous call (or since the meter was started)
+        and start a new sample. Returns the count and the duration it covers.
+        Unlike `pulses_in_window`, this counts every pulse however long ago
+        the previous sample was, so stalls between samples show up in it.
+        """
+        # read and reset together, so concurrent samples (the measurement
+        # loop and /api/measure_now) never count the same pulses
+        with self.lock:
+            now_ns = time.monotonic_ns()
+            pulses = self.pulse_count - self.sample_count
+            seconds = (now_ns - self.sample_ns) / 1e9
+            self.sample_count, self.sample_ns = self.pulse_count, now_ns
+        return pulses, seconds
+
+    def rate(self, seconds=5):
+        """Average flow rate over the last `seconds` seconds, in gallons per
+        hour."""
+        pulses, covered = self.pulses_in_window(seconds)
+        if covered <= 0:
+            return np.nan
+        return float(self.calibration.convert(pulses, covered))
+
+    def instantaneous_rate(self):
+        """Flow rate from the most recent pulse interval, in gallons per hour.
+        Decays towards zero if no pulse arrives for longer than that
+        interval."""
+        timestamps, _ = self._recent()
+        if len(timestamps) < 2:
+            return 0.0
+        interval_ns = max(timestamps[-1] - timestamps[-2], time.monotonic_ns() - timestamps[-1])
+        return float(self.calibration.convert(1, interval_ns / 1e9))
+
+    def min_rate(self, seconds=15 * 60, bucket_seconds=5):
+        """Lowest average flow rate over any `bucket_seconds` interval in the
+        last `seconds` seconds, in gallons per hour. A short pump stall shows
+        up here even if the average over the whole window looks normal."""
+        now_ns = time.monotonic_ns()
+        window_start_ns = max(now_ns - int(seconds * 1e9), self.start_ns)
+        timestamps, overflowed = self._recent()
+        if overflowed and len(timestamps) and timestamps[0] > window_start_ns:
+            window_start_ns = int(timestamps[0])
+        bucket_ns = int(bucket_seconds * 1e9)
+        n_buckets = (now_ns - window_start_ns) // bucket_ns
+        if n_buckets < 1:
+            return np.nan
+        edges = now_ns - bucket_ns * np.arange(n_buckets, -1, -1, dtype=np.int64)
+        counts, _ = np.histogram(timestamps, bins=edges)
+        return float(self.calibration.convert(counts.min(), bucket_seconds))
+
+    def total_volume(self):
+        """Total volume since the meter was started, in gallons."""
+        return float(self.calibration.volume(self.pulse_count))
+
+    def stats(self):
+        """All flow readings as a dict."""
+        return {
+            "instantaneous": self.instantaneous_rate(),
+            "average_1min": self.rate(60),
+            "average_15min": self.rate(15 * 60),
+            "min_15min": self.min_rate(),
+            "total_volume": self.total_volume(),
+        }
@@ -0,0 +1,210 @@
+import fcntl
+import io
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from dataclasses import fields
+from datetime import datetime, timezone
+import numpy as np
+from sensors_data import RawSensorData, SensorData
+
+"""
+Local storage and bulk export of sensor history.
+
+Two kinds of samples are stored: converted SensorData in `HISTORY_DIR`, and the
+RawSensorData they were derived from in `RAW_HISTORY_DIR`, so that history can
+be reprocessed with a corrected calibration (see reprocess.py).
+
+Samples are appended to one file per UTC day as fixed-width binary records (an
+int64 unix time followed by one float32 per field), so reading a range is a
+single `np.frombuffer` per day instead of a round trip per document.
+
+Exports are columnar: a compressed `.npz` archive with one float32 array per
+field and delta-encoded timestamps. Use `write_export` to produce one and
+`read_export` to load it back, e.g. for analysis in a notebook.
+"""
+
+HISTORY_DIR = os.getenv("HISTORY_DIR", "data/history")
+RAW_HISTORY_DIR = os.getenv("RAW_HISTORY_DIR", "data/raw")
+
+# every numeric field of SensorData/RawSensorData except the timestamp; each
+# tank has its own directory, so the tank ID isn't stored
+SENSOR_FIELDS = [f.name for f in fields(SensorData) if f.name not in ("unix_time", "tank_id")]
+RAW_FIELDS = [f.name for f in fields(RawSensorData) if f.name != "unix_time"]
+
+def make_dtype(field_names):
+    """Build the on-disk record type for the given fields."""
+    return np.dtype([("unix_time", "<i8")] + [(name, "<f4") for name in field_names])
+
+def parse_time(value):
+    """Parse a unix time in seconds or an ISO 8601 date/datetime (UTC if no
+    timezone is given). Returns None for None or an empty string. Raises
+    ValueError for anything else that isn't a time."""
+    if value is None or value == "":
+        return None
+    try:
+        return int(float(value))
+    except OverflowError:
+        # e.g. "inf" or "1e400"
+        raise ValueError(f"time out of range: {value!r}") from None
+    except ValueError:
+        pass
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+def _day_of(unix_time):
+    return datetime.fromtimestamp(unix_time, tz=timezone.utc).strftime("%Y-%m-%d")
+
+class HistoryStore:
+    """
+    Append-only store of samples, split into one file per UTC day. Each store
+    has a fixed set of float fields; use separate directories for data with a
+    different layout.
+    """
+
+    def __init__(self, root=HISTORY_DIR, field_names=SENSOR_FIELDS):
+        self.root = root
+        self.field_names = list(field_names)
+        self.dtype = make_dtype(self.field_names)
+        self.lock = threading.Lock()
+
+    def _path(self, day):
+        return os.path.join(self.root, f"{day}.bin")
+
+    @contextmanager
+    def _locked(self):
+        """Hold the store's lock, which also excludes other processes (e.g.
+        reprocess.py while the sensors actor keeps appending)."""
+        with self.lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(os.path.join(self.root, ".lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def days(self):
+        """Sorted list of days (as YYYY-MM-DD strings) that have data."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name[:-4] for name in os.listdir(self.root) if name.endswith(".bin"))
+
+    def append(self, sample):
+        """Append one sample, given as a dataclass or a dict with a unix_time
+        key and a value for every field. Missing values are stored as NaN."""
+        if not isinstance(sample, dict):
+            sample = sample.__dict__
+        record = np.zeros(1, dtype=self.dtype)
+        record["unix_time"] = sample["unix_time"]
+        for name in self.field_names:
+            value = sample.get(name)
+            record[name] = np.nan if value is None else value
+        with self._locked():
+            with open(self._path(_day_of(sample["unix_time"])), "ab") as f:
+                f.write(record.tobytes())
+
+    def _to_records(self, columns):
+        records = np.zeros(len(columns["unix_time"]), dtype=self.dtype)
+        records["unix_time"] = columns["unix_time"]
+        for name in self.field_names:
+            records[name] = columns[name]
+        return records
+
+    def replace(self, columns):
+        """
+        Insert samples given as columns (like the result of `read`), replacing
+        any stored samples with the same unix_time. Each affected day file is
+        rewritten atomically.
+        """
+        records = self._to_records(columns)
+        day_numbers = records["unix_time"] // 86400
+        with self._locked():
+            for day_number in np.unique(day_numbers):
+                day = _day_of(int(day_number) * 86400)
+                new = records[day_numbers == day_number]
+                path = self._path(day)
+                if os.path.exists(path):
+                    old = self._read_day(day)
+                    old = old[~np.isin(old["unix_time"], new["unix_time"])]
+                    new = np.concatenate([old, new])
+                new = new[np.argsort(new["unix_time"], kind="stable")]
+                fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=f"{day}.", suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(new.tobytes())
+                os.replace(tmp_path, path)
+
+    def _read_day(self, day):
+        with open(self._path(day), "rb") as f:
+            buf = f.read()
+        # ignore a partially written trailing record
+        n = len(buf) // self.dtype.itemsize
+        return np.frombuffer(buf, dtype=self.dtype, count=n)
+
+    def read(self, start=None, end=None, field_names=None):
+        """
+        Read all samples with start <= unix_time < end (either bound may be
+        None). Returns a dict mapping "unix_time" and each requested field to a
+        numpy array, sorted by time.
+        """
+        field_names = self.field_names if field_names is None else list(field_names)
+        unknown = set(field_names) - set(self.field_names)
+        if unknown:
+            raise ValueError(f"unknown fields: {sorted(unknown)}")
+
+        first_day = _day_of(start) if start is not None else None
+        last_day = _day_of(end) if end is not None else None
+        chunks = []
+        for day in self.days():
+            if (first_day and day < first_day) or (last_day and day > last_day):
+                continue
+            records = self._read_day(day)
+            mask = np.ones(len(records), dtype=bool)
+            if start is not None:
+                mask &= records["unix_time"] >= start
+            if end is not None:
+                mask &= records["unix_time"] < end
+            chunks.append(records[mask])
+
+        records = np.concatenate(chunks) if chunks else np.zeros(0, dtype=self.dtype)
+        records = records[np.argsort(records["unix_time"], kind="stable")]
+        columns = {"unix_time": records["unix_time"].copy()}
+        for name in field_names:
+            columns[name] = records[name].copy()
+        return columns
+
+def write_export(columns, f):
+    """
+    Write columns (as returned by `HistoryStore.read`) to a file object as a
+    compressed npz archive. Timestamps are stored as a start time plus int32
+    deltas, values as float32.
+    """
+    unix_time = np.asarray(columns["unix_time"], dtype=np.int64)
+    arrays = {
+        "unix_time_start": np.int64(unix_time[0] if len(unix_time) else 0),
+        "unix_time_delta": np.diff(unix_time, prepend=unix_time[:1]).astype(np.int32),
+    }
+    for name, values in columns.items():
+        if name != "unix_time":
+            arrays[name] = np.asarray(values, dtype=np.float32)
+    np.savez_compressed(f, **arrays)
+
+def export_bytes(columns):
+    """Like `write_export`, but returns the archive as bytes."""
+    buf = io.BytesIO()
+    write_export(columns, buf)
+    return buf.getvalue()
+
+def read_export(f):
+    """Load an archive written by `write_export` back into columns."""
+    with np.load(f) as archive:
+        columns = {
+            "unix_time": archive["unix_time_start"] + np.cumsum(archive["unix_time_delta"], dtype=np.int64),
+        }
+        for name in archive.files:
+            if name not in ("unix_time_start", "unix_time_delta"):
+                columns[name] = archive[name]
+    return columns
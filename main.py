@@ -6,9 +6,10 @@ import dotenv
 import sys
 
 from firebase import Firebase
-from notifs import Notifs
-from sensors import Sensors
+from notifs import Notifs, ResubscribeToStats
+from sensors import Sensors, get_actor_sensors
 from api_server import Server
+from tanks import load_tanks
 
 """
 Main script for AutoAquaponics system. This script starts all the actors and
@@ -20,6 +21,9 @@ reads from the sensors, and a "firebase" actor that manages interactions with
 the cloud. The actors can independently crash without taking down the entire
 program.
 
+There is one sensors actor per tank (see tanks.py); all other actors are shared
+by every tank.
+
 To access an actor, you can either pass the actor reference directly in a
 message if you need that specific actor, or if you just need the subsystem, you
 can use the global pykka actor registry:
@@ -44,6 +48,10 @@ def main():
     try:
         global_logger.info("Hello World!")
 
+        tanks = load_tanks()
+        tank_ids = [tank.tank_id for tank in tanks]
+        global_logger.info(f"Tanks: {', '.join(tank_ids)}")
+
         # keep alive forever
         while True:
             global_logger.debug("checking and starting actors")
@@ -51,22 +59,27 @@ def main():
             # Check and start server actor if not running
             if not pykka.ActorRegistry.get_by_class(Server):
                 global_logger.debug("starting server actor")
-                Server.start()
+                Server.start(tanks=tanks)
 
             # Check and start firebase actor if not running
             if not pykka.ActorRegistry.get_by_class(Firebase):
                 global_logger.debug("starting firebase actor")
-                Firebase.start()
+                Firebase.start(tank_ids=tank_ids)
+
+                # a new firebase actor doesn't know about existing subscribers
+                for actor_notifs in pykka.ActorRegistry.get_by_class(Notifs):
+                    actor_notifs.tell(ResubscribeToStats())
 
             # Check and start notifs actor if not running
             if not pykka.ActorRegistry.get_by_class(Notifs):
                 global_logger.debug("starting notifs actor")
                 Notifs.start()
 
-            # Check and start sensors actor if not running
-            if not pykka.ActorRegistry.get_by_class(Sensors):
-                global_logger.debug("starting sensors actor")
-                Sensors.start()
+            # Check and start the sensors actor of each tank if not running
+            for tank in tanks:
+                if not get_actor_sensors(tank.tank_id):
+                    global_logger.debug(f"starting sensors actor for tank {tank.tank_id}")
+                    Sensors.start(tank=tank)
 
             global_logger.debug("staying alive")
             time.sleep(60)
@@ -3,15 +3,19 @@ from logs import register_logger
 from firebase import StatsUpdate, GetTolerances, GetNotificationRecipients, SubscribeToStats, UnsubscribeFromStats, Firebase
 from email_sender import send_email
 from slack_sender import send_slack_message
+from anomaly import AnomalyDetector
+from actor_mailbox import BoundedMailboxMixin, DROP_OLDEST
+from tanks import DEFAULT_TANK_ID
 from dataclasses import dataclass
 from typing import List
+from sensors_data import SensorData
 
 notifs_logger = register_logger("logs/notifs.log", "Notifications")
 
 def _check_tolerances(sensor_data, tolerances):
     """Check if sensor data is within tolerances."""
     alerts = []
-    fields_to_check = ['TDS', 'air_temp', 'distance', 'humidity', 'pH', 'water_temp']
+    fields_to_check = ['TDS', 'air_temp', 'distance', 'flow', 'humidity', 'pH', 'water_temp']
 
     for field in fields_to_check:
         if field in sensor_data and field in tolerances:
@@ -41,18 +45,48 @@ class SendAlert:
     alerts: List[str]
     recipients: List[str]
 
+@dataclass
+class NewSample:
+    """Message with a newly measured sample, sent by the sensors actor for
+    every measurement, for sensor fault detection."""
+    data: SensorData
+
+@dataclass
+class ResubscribeToStats:
+    """Message to subscribe to stats updates again, e.g. after the firebase
+    actor has been restarted."""
+    pass
+
 def get_actor_firebase():
     """Get the first firebase actor."""
     lst = pykka.ActorRegistry.get_by_class(Firebase)
     return lst[0] if lst else None
 
-class Notifs(pykka.ThreadingActor):
+class Notifs(BoundedMailboxMixin, pykka.ThreadingActor):
+    # if alerting falls behind, only the most recent stats updates matter
+    mailbox_messages = (StatsUpdate,)
+    mailbox_size = 10
+    mailbox_policy = DROP_OLDEST
+    mailbox_logger = notifs_logger
+
     def __init__(self, notifs_logger=notifs_logger):
         super().__init__()
         self.notifs_logger = notifs_logger
-        self.first_time = True
+
+        # tanks for which the first stats update has already been seen; the
+        # first update of each tank never alerts
+        self.seen_tanks = set()
+
+        # streaming sensor fault detection, per tank; see anomaly.py. It is
+        # fed every sample directly by the sensors actors, since the stats
+        # listener only delivers the latest document and nothing while
+        # Firebase is offline
+        self.detectors = {}
 
     def on_start(self):
+        self.subscribe_to_stats()
+
+    def subscribe_to_stats(self):
         if actor_firebase := get_actor_firebase():
             self.notifs_logger.info("Starting real-time monitoring of sensor data")
             actor_firebase.tell(SubscribeToStats(actor_ref=self.actor_ref))
@@ -74,10 +108,19 @@ class Notifs(pykka.ThreadingActor):
             self._handle_sensor_update(message.data)
             return
 
+        if isinstance(message, NewSample):
+            self._handle_new_sample(message.data)
+            return
+
+        if isinstance(message, ResubscribeToStats):
+            self.subscribe_to_stats()
+            return
+
         self.notifs_logger.warning(f"Received unknown message type: {type(message)}")
 
     def _handle_sensor_update(self, sensor_data):
-        """Handle real-time updates to sensor data."""
+        """Handle real-time updates to sensor data: check them against the
+        tolerances."""
         self.notifs_logger.debug(f"Processing sensor data: {sensor_data}")
 
         actor_firebase = get_actor_firebase()
@@ -85,25 +128,53 @@ class Notifs(pykka.ThreadingActor):
             self.notifs_logger.warning("No firebase actor found")
             return
 
-        tolerances = actor_firebase.ask(GetTolerances())
-        if not tolerances:
+        tank_id = sensor_data.get('tank_id', DEFAULT_TANK_ID)
+        tolerances = actor_firebase.ask(GetTolerances(tank_id=tank_id))
+        alerts = []
+        if tolerances:
+            alerts = _check_tolerances(sensor_data, tolerances)
+        else:
             self.notifs_logger.warning("No tolerances defined")
-            return
 
-        alerts = _check_tolerances(sensor_data, tolerances)
         if alerts:
-            recipients = actor_firebase.ask(GetNotificationRecipients())
-            subject = "Aquaponics System Alert"
-            body = "The following issues were detected:\n\n" + "\n".join(alerts)
-
-            self.notifs_logger.debug(f"Alerts generated for this update: {repr(body)}")
-            if not self.first_time:
-                for recipient in recipients:
-                    self.notifs_logger.debug(f"Sending email to {recipient}")
-                    send_email(recipient, subject, body)
-                self.notifs_logger.debug(f"Sending slack message")
-                send_slack_message(body)
+            if tank_id in self.seen_tanks:
+                self._send_alerts(tank_id, alerts)
+            else:
+                self.notifs_logger.debug(f"Not alerting on the first update of tank {tank_id}: {alerts}")
         else:
             self.notifs_logger.debug("No alerts generated for this update")
-        self.first_time = False
+        self.seen_tanks.add(tank_id)
+
+    def _handle_new_sample(self, data):
+        """Run sensor fault detection on a newly measured sample."""
+        if alerts := self._detect_faults(data.tank_id, data.__dict__):
+            self._send_alerts(data.tank_id, alerts)
+
+    def _send_alerts(self, tank_id, alerts):
+        """Send alerts about the given tank to Slack and all notification
+        recipients."""
+        subject = f"Aquaponics System Alert: tank {tank_id}"
+        body = f"The following issues were detected in tank {tank_id}:\n\n" + "\n".join(alerts)
+        self.notifs_logger.debug(f"Alerts generated: {repr(body)}")
+
+        if actor_firebase := get_actor_firebase():
+            recipients = actor_firebase.ask(GetNotificationRecipients())
+        else:
+            self.notifs_logger.warning("No firebase actor found, only sending slack message")
+            recipients = []
+        for recipient in recipients:
+            self.notifs_logger.debug(f"Sending email to {recipient}")
+            send_email(recipient, subject, body)
+        self.notifs_logger.debug(f"Sending slack message")
+        send_slack_message(body)
+
+    def _detect_faults(self, tank_id, sensor_data):
+        """Run fault detection on a new sample of the given tank and return
+        alert messages."""
+        if tank_id not in self.detectors:
+            self.detectors[tank_id] = AnomalyDetector(['TDS', 'air_temp', 'humidity', 'pH', 'flow', 'dissolved_oxygen'])
+        events = self.detectors[tank_id].update(sensor_data)
+        for event in events:
+            self.notifs_logger.info(f"Sensor fault detected in tank {tank_id}: {event}")
+        return [f"possible sensor fault: {event.message}" for event in events]
 
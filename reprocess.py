@@ -0,0 +1,59 @@
+import argparse
+import sys
+import time
+from calibration import CALIBRATION_PROFILE_PATH, load_profile
+from history import HISTORY_DIR, RAW_FIELDS, RAW_HISTORY_DIR, HistoryStore, parse_time, write_export
+from tanks import find_tank, load_tanks
+
+"""
+Command line tool for re-deriving sensor history from stored raw readings with
+a (new) calibration profile.
+
+Example: after fixing the pH calibration, recompute all of March and overwrite
+the local history with the corrected values.
+
+    python reprocess.py --start 2024-03-01 --end 2024-04-01 --calibration calibration.json --write
+
+Use `--output` instead of `--write` to only export the result (see export.py).
+With several tanks configured (see tanks.py), pick one with `--tank`; its
+directories and calibration profile are used unless given explicitly.
+Data that has already been uploaded to Firestore is not changed.
+"""
+
+def reprocess(raw_store, profile, start=None, end=None):
+    """Read raw readings in [start, end) and convert them with the given
+    calibration profile. Returns the converted columns."""
+    raw = raw_store.read(start, end, RAW_FIELDS)
+    return profile.convert_raw(raw)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reprocess raw sensor readings with a calibration profile.")
+    parser.add_argument("--start", help="first time to include (unix seconds or ISO date)")
+    parser.add_argument("--end", help="time to stop before (unix seconds or ISO date)")
+    parser.add_argument("--tank", help="tank to reprocess (default: the first configured tank)")
+    parser.add_argument("--calibration",
+                        help=f"calibration profile (default: the tank's, usually {CALIBRATION_PROFILE_PATH})")
+    parser.add_argument("--raw-dir", help=f"raw history directory (default: the tank's directory in {RAW_HISTORY_DIR})")
+    parser.add_argument("--dir", help=f"history directory to update (default: the tank's directory in {HISTORY_DIR})")
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument("--write", action="store_true", help="replace the affected samples in the history directory")
+    output.add_argument("-o", "--output", help="write the result as an export archive instead")
+    args = parser.parse_args(argv)
+
+    tank = find_tank(load_tanks(), args.tank)
+    profile = load_profile(args.calibration or tank.calibration_path)
+
+    start_time = time.perf_counter()
+    raw_store = HistoryStore(args.raw_dir or tank.data_dir(RAW_HISTORY_DIR), RAW_FIELDS)
+    columns = reprocess(raw_store, profile, parse_time(args.start), parse_time(args.end))
+
+    if args.write:
+        HistoryStore(args.dir or tank.data_dir(HISTORY_DIR)).replace(columns)
+    else:
+        with open(args.output, "wb") as f:
+            write_export(columns, f)
+    elapsed = time.perf_counter() - start_time
+    print(f"reprocessed {len(columns['unix_time'])} samples in {elapsed:.2f} s", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,12 @@ import adafruit_ads1x15.ads1115 as ADS
 from adafruit_ads1x15.analog_in import AnalogIn
 import adafruit_dht
 from firebase import AddSensorData, Firebase
-from sensors_data import SensorData
+from notifs import NewSample, Notifs
+from sensors_data import RawSensorData, SensorData
+from history import HISTORY_DIR, RAW_FIELDS, RAW_HISTORY_DIR, HistoryStore
+from calibration import DEFAULT_WATER_TEMP, load_profile
+from flow_meter import FlowMeter
+from tanks import default_tank
 from dataclasses import dataclass
 
 sensor_logger = register_logger("logs/sensors.log", "Sensors")
@@ -21,84 +26,115 @@ sensor_logger = register_logger("logs/sensors.log", "Sensors")
 # resources. These functions then perform the device-specific operations
 # required to take a measurement and return a meaningful value.
 
-def measure_ph(ph_adc):
+def measure_ph(ph_adc, calibration):
     """Get pH reading."""
-    neutral_voltage = 1.38102  # the voltage when the pH is 7
-    inverse_slope = -0.161711  # volts per pH unit
-    return (ph_adc.voltage - neutral_voltage) / inverse_slope + 7.0
-
-def measure_do(do_adc):
-    do_table = [14460, 14220, 13820, 13440, 13090, 12740, 12420, 12110, 11810, 11530,
-            11260, 11010, 10770, 10530, 10300, 10080, 9860, 9660, 9460, 9270,
-            9080, 8900, 8730, 8570, 8410, 8250, 8110, 7960, 7820, 7690,
-            7560, 7430, 7300, 7180, 7070, 6950, 6840, 6730, 6630, 6530, 6410]
-    v_cal = 0.81 # voltage when fully saturated
-    v_temp = 23.4 # temperature in C for above measurement
-    v_saturation = v_cal + 35 * v_temp - v_temp * 35
-
-    # current water temperature in C. this should be obtained
-    # from a sensor but we don't have that yet so use a dummy value
-    wtemp_c = 25.6
-
-    mg_per_liter = do_adc.voltage * do_table[int(wtemp_c)] / v_saturation / 1000
-    return mg_per_liter
-
-def measure_flow(gpio, flow_pin, t_sec=5):
-    """Get flow rate reading."""
-    flow_cb = GPIO.callback(gpio, flow_pin, GPIO.FALLING_EDGE)
-    time.sleep(t_sec)
-    count = flow_cb.tally()
-    freq = count/t_sec
-    flow = (freq / 0.2) * 15.850323141489  # Pulse frequency (Hz) = 0.2Q, Q is flow rate in GPH
-    flow_cb.cancel()
-    return flow
+    return float(calibration.convert(ph_adc.voltage))
+
+def measure_do(do_adc, calibration, wtemp=DEFAULT_WATER_TEMP):
+    """Get dissolved oxygen reading in mg/L."""
+    return float(calibration.convert(do_adc.voltage, wtemp))
+
+def measure_tds(tds_adc, calibration, wtemp=25):
+    """Get TDS reading in ppm."""
+    return float(calibration.convert(tds_adc.voltage, wtemp))
+
+# Hardware shared by the sensors of all tanks: the GPIO chip and the I2C bus.
+# These are opened once per process and stay open.
+_shared_hardware = {}
+_shared_hardware_lock = threading.Lock()
+
+def get_gpio():
+    """Get the shared GPIO chip handle."""
+    with _shared_hardware_lock:
+        if "gpio" not in _shared_hardware:
+            _shared_hardware["gpio"] = GPIO.gpiochip_open(0)
+        return _shared_hardware["gpio"]
+
+def get_i2c():
+    """Get the shared I2C bus."""
+    with _shared_hardware_lock:
+        if "i2c" not in _shared_hardware:
+            _shared_hardware["i2c"] = busio.I2C(board.SCL, board.SDA)
+        return _shared_hardware["i2c"]
 
 class SensorsHardware:
     """
     This class encapsulates all hardware resources involved with taking sensor
-    measurements. When constructed, this class initializes those hardware
-    resources. Methods on this class then use the relevant resources to take
-    measurements, delegating to other functions to actually perform the
+    measurements for one tank. When constructed, this class initializes those
+    hardware resources. Methods on this class then use the relevant resources
+    to take measurements, delegating to other functions to actually perform the
     device-specific operations.
     """
-    def __init__(self):
+    def __init__(self, tank=None, calibration=None):
+        self.tank = tank or default_tank()
+
+        # calibration profile for converting probe voltages
+        self.calibration = calibration or load_profile(self.tank.calibration_path)
+
         # initialize GPIO
-        self.flow_pin = 16
-        self.gpio = GPIO.gpiochip_open(0)
+        self.flow_pin = self.tank.flow_pin
+        self.gpio = get_gpio()
         GPIO.gpio_claim_alert(self.gpio, self.flow_pin, eFlags=GPIO.FALLING_EDGE, lFlags=GPIO.SET_PULL_UP)
 
+        # count flow pulses continuously in the background
+        self.flow_meter = FlowMeter(self.gpio, self.flow_pin, self.calibration.flow)
+        self.flow_meter.start()
+
         # initialize I2C and ADC
-        self.i2c = busio.I2C(board.SCL, board.SDA)
-        self.ads = ADS.ADS1115(self.i2c)
+        self.i2c = get_i2c()
+        self.ads = ADS.ADS1115(self.i2c, address=self.tank.adc_address)
         self.ads.gain = 2/3
-        self.adc_ph = AnalogIn(self.ads, ADS.P2)
-        self.raw_tds = AnalogIn(self.ads, ADS.P0)
-        self.adc_do = AnalogIn(self.ads, ADS.P3)
+        self.adc_ph = AnalogIn(self.ads, getattr(ADS, f"P{self.tank.ph_channel}"))
+        self.raw_tds = AnalogIn(self.ads, getattr(ADS, f"P{self.tank.tds_channel}"))
+        self.adc_do = AnalogIn(self.ads, getattr(ADS, f"P{self.tank.do_channel}"))
 
         # initialize DHT
-        self.dht = adafruit_dht.DHT22(board.D27, use_pulseio=False)
+        self.dht = adafruit_dht.DHT22(getattr(board, self.tank.dht_pin), use_pulseio=False)
 
     def measure_all(self) -> SensorData:
+        return self.convert(self.measure_all_raw())
+
+    def measure_all_raw(self) -> RawSensorData:
+        """Take unconverted readings from all sensors. The flow reading covers
+        the whole time since the previous reading, so it is the average flow
+        between samples."""
         temperature, humidity = self.measure_dht()
+        flow_pulses, flow_seconds = self.flow_meter.pulses_since_sample()
 
-        return SensorData(
+        return RawSensorData(
             unix_time=round(time.time()),
-            pH=self.measure_ph(),
-            flow=self.measure_flow(),
+            ph_voltage=self.adc_ph.voltage,
+            tds_voltage=self.raw_tds.voltage,
+            do_voltage=self.adc_do.voltage,
+            flow_pulses=flow_pulses,
+            flow_seconds=flow_seconds,
             air_temp=temperature,
             humidity=humidity,
-            TDS = self.get_tds(),
-            dissolved_oxygen = self.measure_do(),
+        )
+
+    def convert(self, raw: RawSensorData) -> SensorData:
+        """Convert raw readings using the calibration profile."""
+        converted = self.calibration.convert_raw(raw.__dict__)
+        return SensorData(
+            unix_time=raw.unix_time,
+            tank_id=self.tank.tank_id,
+            **{name: float(value) for name, value in converted.items() if name != "unix_time"},
         )
 
     def measure_ph(self):
-        return measure_ph(self.adc_ph)
+        return measure_ph(self.adc_ph, self.calibration.ph)
 
     def measure_flow(self):
-        return measure_flow(self.gpio, self.flow_pin)
+        return self.flow_meter.rate()
+
+    def close(self):
+        """Release hardware resources."""
+        self.flow_meter.stop()
+        GPIO.gpio_free(self.gpio, self.flow_pin)
+        self.dht.exit()
 
     def measure_do(self):
-        return measure_do(self.adc_do)
+        return measure_do(self.adc_do, self.calibration.do)
 
     def measure_dht(self):
         def is_nan(x):  #used in DHT function
@@ -121,16 +157,8 @@ class SensorsHardware:
                 raise error
         return temperature_c, humidity
     def get_tds(self, wtemp=25):
-        Vtds_raw = self.raw_tds.voltage        #raw reading from sensor right now
-        TheoEC = 684                    #theoretical EC (electrical conductivity) of calibration fluid (calibrated with 342 ppm of aqueous NaCl)
-        Vc = 1.085751885                #voltage reading of sensor when calibrating
-        temp_calibrate = 23.25          #measured water temp when calibrating
-        rawECsol = TheoEC*(1+0.02*(temp_calibrate-25))  #temp compensate the calibrated values
-        K = (rawECsol)/(133.42*(Vc**3)-255.86*(Vc**2)+857.39*Vc)  #defined calibration factor K for NaCl (this will have to be readjusted for specific solution in tank)
-        EC_raw = K*(133.42*(Vtds_raw**3)-255.86*(Vtds_raw**2)+857.39*Vtds_raw)
-        EC = EC_raw/(1+0.02*(wtemp-25)) #use current temp for temp compensation
-        TDS = EC/2                      #TDS is just half of electrical conductivity in ppm
-        return TDS
+        return measure_tds(self.raw_tds, self.calibration.tds, wtemp)
+
 # Data type definitions for messages for the sensors actor. Sending messages of
 # these types to the actor will cause it to perform certain actions.
 # See main.py for more information on the actor system.
@@ -151,6 +179,30 @@ class TriggerSensorLoop:
     """Message to trigger the sensor loop."""
     logging_interval: int
 
+# the sensors actor and flow meter of each tank, by tank ID
+_actors_sensors = {}
+_flow_meters = {}
+
+def get_actor_sensors(tank_id=None):
+    """Get the running sensors actor of the given tank, or of the first tank
+    if tank_id is None."""
+    if tank_id is None:
+        lst = pykka.ActorRegistry.get_by_class(Sensors)
+        return lst[0] if lst else None
+    actor = _actors_sensors.get(tank_id)
+    return actor if actor and actor.is_alive() else None
+
+def get_actor_notifs():
+    """Get the first notifs actor."""
+    lst = pykka.ActorRegistry.get_by_class(Notifs)
+    return lst[0] if lst else None
+
+def get_flow_meter(tank_id):
+    """Get the running flow meter of the given tank. FlowMeter is thread safe,
+    so it can be queried directly without waiting for the (possibly busy)
+    sensors actor."""
+    return _flow_meters.get(tank_id)
+
 def get_actor_firebase():
     """Get the first firebase actor."""
     lst = pykka.ActorRegistry.get_by_class(Firebase)
@@ -158,15 +210,18 @@ def get_actor_firebase():
 
 class Sensors(pykka.ThreadingActor):
     """
-    This actor is responsible for all business related to the sensors. As part
-    of its responsibilities, it takes periodic measurements from the sensors
-    using a SensorsHardware object and sends them to the firebase actor.
+    This actor is responsible for all business related to the sensors of one
+    tank. As part of its responsibilities, it takes periodic measurements from
+    the sensors using a SensorsHardware object and sends them to the firebase
+    actor.
     """
 
-    def __init__(self, sensor_logger=sensor_logger):
+    def __init__(self, tank=None, sensor_logger=sensor_logger):
         super().__init__()
 
+        self.tank = tank or default_tank()
         self.logger = sensor_logger
+        _actors_sensors[self.tank.tank_id] = self.actor_ref
 
         # initialize latest sensor values
         self.pH = np.nan
@@ -181,18 +236,24 @@ class Sensors(pykka.ThreadingActor):
         # a SensorsHardware object for actually performing the measurements
         self.hardware = None
 
+        # local copy of every measurement, for bulk export, and of the raw
+        # readings it was derived from, for reprocessing
+        self.history = HistoryStore(self.tank.data_dir(HISTORY_DIR))
+        self.raw_history = HistoryStore(self.tank.data_dir(RAW_HISTORY_DIR), RAW_FIELDS)
+
     def on_start(self):
         """Initialize hardware and start data collection."""
 
         try:
-            self.logger.info("Initializing sensors hardware")
-            self.hardware = SensorsHardware()
+            self.logger.info(f"Initializing sensors hardware for tank {self.tank.tank_id}")
+            self.hardware = SensorsHardware(self.tank)
+            _flow_meters[self.tank.tank_id] = self.hardware.flow_meter
 
             # send messages to self to start the measurement loop
             self.actor_ref.tell(StabilizeMeasurements())
             self.actor_ref.tell(TriggerSensorLoop(logging_interval=15 * 60))
         except Exception as e:
-            self.logger.error(f"Error initializing sensors hardware: {e}")
+            self.logger.error(f"Error initializing sensors hardware for tank {self.tank.tank_id}: {e}")
             raise e
 
     def on_receive(self, message):
@@ -220,12 +281,14 @@ class Sensors(pykka.ThreadingActor):
     def on_stop(self):
         """Clean up hardware resources."""
         self.logger.info("Stopping sensors")
-        if self.gpio:
-            GPIO.gpiochip_close(self.gpio)
+        if _flow_meters.get(self.tank.tank_id) is getattr(self.hardware, "flow_meter", None):
+            _flow_meters.pop(self.tank.tank_id, None)
+        if self.hardware:
+            self.hardware.close()
 
     def on_failure(self, failure):
         """Handle actor failures."""
-        self.logger.error(f"Sensors actor failed: {failure}")
+        self.logger.error(f"Sensors actor for tank {self.tank.tank_id} failed: {failure}")
         self.on_stop()
 
     # custom methods
@@ -244,12 +307,24 @@ class Sensors(pykka.ThreadingActor):
         """
         Get and send data.
         """
-        data = self.hardware.measure_all()
+        raw = self.hardware.measure_all_raw()
+        data = self.hardware.convert(raw)
         self.logger.debug(f"Logging data: {data}")
+        try:
+            self.raw_history.append(raw)
+            self.history.append(data)
+        except Exception as e:
+            self.logger.error(f"Couldn't store data locally: {e}")
         if actor_firebase := get_actor_firebase():
             actor_firebase.tell(AddSensorData(data))
         else:
             self.logger.warning("Couldn't send data: no firebase actor found")
+        # fault detection sees every sample, whether or not it reaches
+        # Firestore
+        if actor_notifs := get_actor_notifs():
+            actor_notifs.tell(NewSample(data))
+        else:
+            self.logger.warning("Couldn't check data for sensor faults: no notifs actor found")
 
     def measure_and_send_data_repeated(self):
         """
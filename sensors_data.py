@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from tanks import DEFAULT_TANK_ID
 
 # this has to go here instead of sensors.py to avoid circular import
 
@@ -12,4 +13,18 @@ class SensorData:
     humidity: float
     TDS: float
     dissolved_oxygen: float
+    tank_id: str = DEFAULT_TANK_ID
 
+
+@dataclass
+class RawSensorData:
+    """Unconverted readings from all sensors, from which SensorData can be
+    derived again with a different calibration."""
+    unix_time: int
+    ph_voltage: float
+    tds_voltage: float
+    do_voltage: float
+    flow_pulses: float
+    flow_seconds: float
+    air_temp: float
+    humidity: float
@@ -0,0 +1,360 @@
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass
+import cv2
+import numpy as np
+from logs import register_logger
+
+stream_logger = register_logger("logs/stream.log", "Stream")
+
+"""
+Camera capture, live streaming and recording.
+
+A `FrameSource` owns the camera. It reads and JPEG-encodes each frame exactly
+once on its own thread. A `MotionGate` decides whether a frame differs enough
+from the last published one to be worth encoding; while the scene is static,
+frames are skipped and the capture rate drops, apart from a keyframe every few
+seconds. Live viewers (see the /stream handler in api_server.py) just pick up
+the latest encoded frame, and other consumers such as the `Recorder` register
+as sinks to be handed every frame. While nobody is watching, the source only
+captures at `idle_interval` (the recorder's rate).
+
+The `Recorder` stores the already encoded frames in time-segmented files under
+`RECORDINGS_DIR`, deleting the oldest segments to stay within a storage budget,
+so that footage around an alert can be fetched later with `Recorder.clip`. Each
+segment is a plain concatenation of JPEGs (motion JPEG, playable by e.g.
+ffplay or VLC) with a separate index of frame times and offsets.
+"""
+
+RECORDINGS_DIR = os.getenv("RECORDINGS_DIR", "data/recordings")
+RECORDINGS_MAX_BYTES = int(os.getenv("RECORDINGS_MAX_BYTES", 4 * 1024**3))
+
+@dataclass
+class Frame:
+    """An encoded frame. `seq` increases by one for every captured frame."""
+    seq: int
+    unix_time: float
+    jpeg: bytes
+    from_camera: bool
+
+def draw_pattern():
+    img = np.full((480, 640, 3), 255, dtype=np.uint8)
+
+    # Create an interesting pattern that changes over time
+    t = time.time()
+
+    # Make a copy of base image
+    pattern_img = img.copy()
+
+    # Draw animated sine wave pattern
+    for x in range(0, 640, 5):
+        y = int(240 + 100 * np.sin(x/50 + t))
+        cv2.circle(pattern_img, (x, y), 3, (0, 127, 255), -1)
+
+    # Draw animated circular pattern
+    center_x = 320 + int(50 * np.cos(t))
+    center_y = 240 + int(50 * np.sin(t))
+    radius = int(100 + 20 * np.sin(2*t))
+    cv2.circle(pattern_img, (center_x, center_y), radius, (255, 0, 127), 2)
+
+    # Add some text
+    cv2.putText(pattern_img, 'AutoAquaponics', (20, 50),
+                cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+
+    # Encode image to JPEG
+    success, jpeg_img = cv2.imencode('.jpg', pattern_img)
+    if not success:
+        raise Exception("Failed to encode JPEG")
+    return jpeg_img
+
+class MotionGate:
+    """
+    Cheap change detection for camera frames. Frames are compared with the last
+    frame that was let through, on a subsampled copy of one color channel. A
+    frame counts as changed if more than `min_fraction` of the sampled pixels
+    differ by more than `pixel_threshold`, which ignores sensor noise but
+    catches a fish swimming by. Comparing against the last published frame
+    rather than the previous one means slow changes (e.g. lighting) are
+    eventually let through too.
+
+    `interval` is the suggested time until the next capture: `min_interval`
+    right after a change, growing by `ramp` per static frame up to
+    `max_interval`.
+
+    Passing `force=True` lets a frame through even if it hasn't changed, which
+    FrameSource uses to keep publishing keyframes in a static scene.
+    """
+
+    def __init__(self, min_interval=0.033, max_interval=0.5, ramp=1.25, step=4,
+                 pixel_threshold=20, min_fraction=0.001):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.ramp = ramp
+        self.step = step
+        self.pixel_threshold = pixel_threshold
+        self.min_fraction = min_fraction
+        self.reference = None
+        self.interval = min_interval
+
+    def update(self, frame, force=False):
+        """Check a BGR frame (numpy array). Returns True if it should be
+        published."""
+        small = frame[::self.step, ::self.step, 1].astype(np.int16)
+        changed = True
+        if self.reference is not None and small.shape == self.reference.shape:
+            changed_fraction = np.count_nonzero(np.abs(small - self.reference) > self.pixel_threshold) / small.size
+            changed = changed_fraction > self.min_fraction
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.ramp)
+        if changed or force:
+            self.reference = small
+            return True
+        return False
+
+class FrameSource:
+    """
+    Captures frames from one camera on a background thread. If the camera
+    can't be opened or read, a generated test pattern is produced instead.
+    Camera frames that haven't changed (see MotionGate) are not published,
+    except for a keyframe at least every `keyframe_interval` seconds (or more
+    often if a sink asks for it, see `add_sink`), so that recordings stay
+    continuous in time even when nothing moves. Capture runs at
+    `frame_interval` while live viewers are registered (see `add_viewer`) and
+    at `idle_interval` otherwise; the test pattern is only generated for
+    viewers.
+    """
+
+    def __init__(self, camera_index=0, frame_interval=0.033, idle_interval=0.2, keyframe_interval=2.0,
+                 jpeg_quality=80, motion_gate=True, logger=stream_logger):
+        self.camera_index = camera_index
+        self.frame_interval = frame_interval
+        self.idle_interval = idle_interval
+        self.keyframe_interval = keyframe_interval
+        self.last_publish = None
+        self.viewers = 0
+        self.viewers_lock = threading.Lock()
+        self.jpeg_quality = jpeg_quality
+        self.gate = MotionGate(min_interval=frame_interval) if motion_gate else None
+        self.logger = logger
+        self.capture = None
+        self.latest = None
+        self.sinks = []
+        self.sink_intervals = {}
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.logger.info(f"Starting capture from camera {self.camera_index}")
+        self.capture = cv2.VideoCapture(self.camera_index)
+        # keep the driver from queueing frames while capture slows down, so
+        # the next read is current
+        self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.logger.info(f"Stopping capture from camera {self.camera_index}")
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1)
+        if self.capture:
+            self.capture.release()
+
+    def add_sink(self, sink, min_interval=None):
+        """Register a callable to be called with every new Frame, on the
+        capture thread. Sinks must not block. With `min_interval`, a frame is
+        published at least that often while the sink is registered, even if
+        the scene is static."""
+        self.sinks.append(sink)
+        if min_interval is not None:
+            self.sink_intervals[sink] = min_interval
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+        self.sink_intervals.pop(sink, None)
+
+    def _keyframe_due(self):
+        """Whether an unchanged frame must be published anyway."""
+        if self.last_publish is None:
+            return True
+        interval = min([self.keyframe_interval, *self.sink_intervals.values()])
+        return time.monotonic() - self.last_publish >= interval
+
+    def add_viewer(self):
+        """Register a live viewer, which makes capture run at full rate."""
+        with self.viewers_lock:
+            self.viewers += 1
+
+    def remove_viewer(self):
+        with self.viewers_lock:
+            self.viewers -= 1
+
+    def _read_frame(self):
+        """Read and encode one frame. Returns the JPEG and whether it came
+        from the camera, or None if the frame is unchanged."""
+        if self.capture is not None and self.capture.isOpened():
+            ret, frame = self.capture.read()
+            if ret:
+                if self.gate and not self.gate.update(frame, force=self._keyframe_due()):
+                    return None
+                success, jpeg_img = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality])
+                if success:
+                    return jpeg_img, True
+        if not self.viewers:
+            return None
+        return draw_pattern(), False
+
+    def _run(self):
+        seq = 0
+        while self.running:
+            start = time.monotonic()
+            interval = self.frame_interval
+            try:
+                result = self._read_frame()
+                if result is not None:
+                    jpeg_img, from_camera = result
+                    seq += 1
+                    frame = Frame(seq=seq, unix_time=time.time(), jpeg=jpeg_img.tobytes(), from_camera=from_camera)
+                    self.latest = frame
+                    self.last_publish = time.monotonic()
+                    for sink in list(self.sinks):
+                        sink(frame)
+                if self.gate and (result is None or result[1]):
+                    interval = self.gate.interval
+                if not self.viewers:
+                    interval = max(interval, self.idle_interval)
+            except Exception as e:
+                self.logger.error(f"Error capturing frame: {e}")
+            time.sleep(max(0, interval - (time.monotonic() - start)))
+
+# on-disk index entry for one recorded frame
+INDEX_DTYPE = np.dtype([("unix_time", "<f8"), ("offset", "<i8"), ("length", "<i4")])
+
+class Recorder:
+    """
+    Records camera frames into segments of `segment_seconds` seconds. Whenever
+    a new segment is started, the oldest segments are deleted until the rest
+    fit in `max_bytes`. Frames are written on the recorder's own thread; if it
+    falls behind, frames are dropped rather than slowing down capture.
+    """
+
+    def __init__(self, directory=RECORDINGS_DIR, segment_seconds=300, max_bytes=RECORDINGS_MAX_BYTES,
+                 record_interval=0.2, logger=stream_logger):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.max_bytes = max_bytes
+        self.record_interval = record_interval
+        self.logger = logger
+        self.queue = queue.Queue(maxsize=64)
+        self.last_submitted = 0.0
+        self.segment_start = None
+        self.data_file = None
+        self.index_file = None
+        self.thread = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+        self._close_segment()
+
+    def submit(self, frame):
+        """Sink for FrameSource; records at most one frame per
+        `record_interval` seconds."""
+        if not frame.from_camera or frame.unix_time - self.last_submitted < self.record_interval:
+            return
+        self.last_submitted = frame.unix_time
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.logger.warning("Recorder is falling behind, dropping frame")
+
+    def _run(self):
+        while (frame := self.queue.get()) is not None:
+            try:
+                self._write(frame)
+            except Exception as e:
+                self.logger.error(f"Error recording frame: {e}")
+
+    def _segment_path(self, start, ext):
+        return os.path.join(self.directory, f"{round(start * 1000)}.{ext}")
+
+    def _write(self, frame):
+        if self.segment_start is None or frame.unix_time >= self.segment_start + self.segment_seconds:
+            self._close_segment()
+            self._enforce_budget()
+            self.segment_start = frame.unix_time
+            self.data_file = open(self._segment_path(self.segment_start, "mjpeg"), "ab")
+            self.index_file = open(self._segment_path(self.segment_start, "idx"), "ab")
+            self.logger.debug(f"Started recording segment at {self.segment_start}")
+
+        entry = np.zeros(1, dtype=INDEX_DTYPE)
+        entry["unix_time"] = frame.unix_time
+        entry["offset"] = self.data_file.tell()
+        entry["length"] = len(frame.jpeg)
+        self.data_file.write(frame.jpeg)
+        self.data_file.flush()
+        self.index_file.write(entry.tobytes())
+        self.index_file.flush()
+
+    def _close_segment(self):
+        for f in (self.data_file, self.index_file):
+            if f:
+                f.close()
+        self.data_file = self.index_file = None
+
+    def segments(self):
+        """Start times (unix seconds) of all recorded segments, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        names = [name for name in os.listdir(self.directory) if name.endswith(".mjpeg")]
+        return sorted(int(name.split(".")[0]) / 1000 for name in names)
+
+    def _enforce_budget(self):
+        """Delete the oldest segments until the rest fit in the budget."""
+        segments = self.segments()
+        sizes = [
+            sum(os.path.getsize(self._segment_path(start, ext)) for ext in ("mjpeg", "idx")
+                if os.path.exists(self._segment_path(start, ext)))
+            for start in segments
+        ]
+        total = sum(sizes)
+        for start, size in zip(segments, sizes):
+            if total <= self.max_bytes:
+                break
+            self.logger.info(f"Deleting recording segment {start} to stay within storage budget")
+            for ext in ("mjpeg", "idx"):
+                if os.path.exists(self._segment_path(start, ext)):
+                    os.remove(self._segment_path(start, ext))
+            total -= size
+
+    def clip(self, start, end):
+        """Yield (unix_time, jpeg bytes) for recorded frames with
+        start <= unix_time < end, oldest first."""
+        segments = self.segments()
+        for i, segment_start in enumerate(segments):
+            segment_end = segments[i + 1] if i + 1 < len(segments) else float("inf")
+            if segment_end <= start or segment_start >= end:
+                continue
+            try:
+                with open(self._segment_path(segment_start, "idx"), "rb") as f:
+                    buf = f.read()
+                index = np.frombuffer(buf, dtype=INDEX_DTYPE, count=len(buf) // INDEX_DTYPE.itemsize)
+                index = index[(index["unix_time"] >= start) & (index["unix_time"] < end)]
+                with open(self._segment_path(segment_start, "mjpeg"), "rb") as f:
+                    for unix_time, offset, length in index:
+                        f.seek(offset)
+                        yield float(unix_time), f.read(length)
+            except FileNotFoundError:
+                # deleted by the storage budget while we were reading
+                continue
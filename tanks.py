@@ -0,0 +1,91 @@
+import json
+import os
+from dataclasses import dataclass, fields
+from typing import Optional
+
+"""
+Configuration of the tanks served by this process.
+
+Each tank has its own group of sensors (an ADS1115 ADC, a flow meter and a DHT
+sensor), an optional camera and its own calibration profile. One Sensors actor
+runs per tank, and everything it measures is tagged with the tank's ID.
+
+Tanks are configured in a JSON file (see `TANKS_CONFIG_PATH`), e.g.
+
+    {
+        "tanks": [
+            {"tank_id": "tilapia", "adc_address": 72, "flow_pin": 16, "dht_pin": "D27", "camera_index": 0},
+            {"tank_id": "goldfish", "adc_address": 73, "flow_pin": 20, "dht_pin": "D22", "camera_index": 1,
+             "calibration_path": "calibration_goldfish.json"}
+        ]
+    }
+
+Fields left out get the defaults of `TankConfig`, which describe the original
+single tank setup. Without a config file, that single tank is used and keeps
+storing its data where it always has.
+"""
+
+TANKS_CONFIG_PATH = os.getenv("TANKS_CONFIG_PATH", "tanks.json")
+DEFAULT_TANK_ID = "main"
+
+@dataclass
+class TankConfig:
+    """Hardware and storage configuration of one tank."""
+    tank_id: str = DEFAULT_TANK_ID
+    adc_address: int = 0x48  # I2C address of the ADS1115
+    ph_channel: int = 2  # ADC channels of the probes
+    tds_channel: int = 0
+    do_channel: int = 3
+    flow_pin: int = 16  # GPIO of the flow meter
+    dht_pin: str = "D27"  # board pin of the DHT22
+    camera_index: Optional[int] = 0  # None if the tank has no camera
+    calibration_path: Optional[str] = None  # None for CALIBRATION_PROFILE_PATH
+
+    # the implicit single tank keeps using the top level data directories
+    shared_data_dirs: bool = False
+
+    def data_dir(self, root):
+        """Directory for this tank's data under the given root directory."""
+        return root if self.shared_data_dirs else os.path.join(root, self.tank_id)
+
+def default_tank():
+    """The implicit single tank used without a config file. It keeps storing
+    its data in the top level data directories."""
+    return TankConfig(shared_data_dirs=True)
+
+def load_tanks(path=None):
+    """Load the list of tanks from the config file, or the single default tank
+    if there is no config file."""
+    path = path or TANKS_CONFIG_PATH
+    if not os.path.exists(path):
+        return [default_tank()]
+    with open(path) as f:
+        data = json.load(f)
+
+    known = {f.name for f in fields(TankConfig)} - {"shared_data_dirs"}
+    tanks = []
+    for entry in data["tanks"]:
+        unknown = set(entry) - known
+        if unknown:
+            raise ValueError(f"unknown tank config fields: {sorted(unknown)}")
+        tanks.append(TankConfig(**entry))
+
+    ids = [tank.tank_id for tank in tanks]
+    for tank_id in ids:
+        # tank IDs are used in Firestore paths and document IDs and as
+        # directory names
+        if not isinstance(tank_id, str) or not tank_id or "/" in tank_id or tank_id in (".", ".."):
+            raise ValueError(f"invalid tank ID {tank_id!r}: must be a non-empty string without '/'")
+    if not tanks or len(set(ids)) != len(ids):
+        raise ValueError(f"tank config must list at least one tank with unique IDs, got {ids}")
+    return tanks
+
+def find_tank(tanks, tank_id=None):
+    """Tank with the given ID, or the first tank if tank_id is None. Raises
+    KeyError if there is no such tank."""
+    if tank_id is None:
+        return tanks[0]
+    for tank in tanks:
+        if tank.tank_id == tank_id:
+            return tank
+    raise KeyError(f"no tank {tank_id!r}")
@@ -0,0 +1,62 @@
+import os
+import sys
+import threading
+from dataclasses import dataclass
+import pykka
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from actor_mailbox import SPILL, BoundedMailboxMixin
+from disk_queue import DiskQueue
+
+@dataclass
+class Work:
+    n: int
+
+release = threading.Event()
+
+class Worker(BoundedMailboxMixin, pykka.ThreadingActor):
+    mailbox_messages = (Work,)
+    mailbox_size = 5
+    mailbox_policy = SPILL
+
+    def __init__(self, processed):
+        super().__init__()
+        self.processed = processed
+
+    def on_receive(self, message):
+        release.wait()
+        self.processed.append(message.n)
+
+def test_spilled_messages_survive_stop(tmp_path, monkeypatch):
+    monkeypatch.setattr("actor_mailbox.SPILL_DIR", str(tmp_path))
+
+    # hold the first message until the stop has been queued behind all 50
+    processed = []
+    release.clear()
+    actor = Worker.start(processed)
+    for i in range(50):
+        actor.tell(Work(i))
+    stop = threading.Thread(target=actor.stop)
+    stop.start()
+    release.set()
+    stop.join()
+    # pykka replies to the stop before draining the inbox; wait for that too
+    for thread in threading.enumerate():
+        if thread.name.startswith("Worker"):
+            thread.join()
+
+    # only the messages that were in memory may be lost; the rest stay
+    # spilled, in order
+    spill = DiskQueue(os.path.join(tmp_path, "Worker.queue"))
+    spilled = [envelope.message.n for envelope in spill.peek(len(spill))]
+    spill.close()
+    assert len(processed) + len(spilled) >= 50 - Worker.mailbox_size
+    assert spilled == list(range(50 - len(spilled), 50))
+
+    # a new actor picks up where the old one stopped
+    processed_again = []
+    Worker.start(processed_again).stop()
+    assert len(processed_again) >= Worker.mailbox_size
+    assert processed_again == spilled[:len(processed_again)]
+    pykka.ActorRegistry.stop_all()